@@ -1,23 +1,30 @@
 import os
 import json
-import requests
+import re
+import unicodedata
+import httpx
 import bcrypt
 import base64
 import hashlib
 import io
-from flask import Flask, request, jsonify, Response, session, render_template, send_file
+import threading
+import time
+import click
+from collections import OrderedDict, deque
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import Flask, request, jsonify, Response, session, render_template, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event
+from sqlalchemy.orm import DeclarativeBase, Session
 from datetime import datetime, timedelta
 from openai import OpenAI
-from supabase import create_client, Client
 
-# Supabase client initialization
+# Supabase credentials (the client itself is created lazily by SupabaseStorage)
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # OpenRouter AI Integration - uses Replit AI Integrations (no API key needed, charges to credits)
 AI_INTEGRATIONS_OPENROUTER_API_KEY = os.environ.get("AI_INTEGRATIONS_OPENROUTER_API_KEY")
@@ -53,12 +60,16 @@ app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=30)
 db.init_app(app)
 
+# Endpoints that set their own Cache-Control (immutable content or ETag revalidation), left alone below
+CACHEABLE_ENDPOINTS = {'serve_cached_image', 'serve_local_storage', 'serve_attached_assets', 'get_stored_photos_batch'}
+
 @app.after_request
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    if request.endpoint not in CACHEABLE_ENDPOINTS:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     return response
 
 @app.teardown_appcontext
@@ -79,15 +90,25 @@ class User(db.Model):
 
 class Match(db.Model):
     __tablename__ = 'matches'
+    __table_args__ = (
+        db.Index('uq_matches_user_girl', 'user_id', 'girl_id', unique=True),
+        db.Index('ix_matches_user_sync', 'user_id', 'sync_version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     girl_id = db.Column(db.String(50), nullable=False)
     affection = db.Column(db.Integer, default=20)
     matched_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        db.Index('ix_chat_messages_user_girl_id', 'user_id', 'girl_id', 'id'),
+        db.Index('ix_chat_messages_user_girl_time_id', 'user_id', 'girl_id', 'timestamp', 'id'),
+        db.Index('ix_chat_messages_user_sync', 'user_id', 'sync_version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     girl_id = db.Column(db.String(50), nullable=False)
@@ -95,19 +116,48 @@ class ChatMessage(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     time_str = db.Column(db.String(10), nullable=True)
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+
+class ChatReadMarker(db.Model):
+    __tablename__ = 'chat_read_markers'
+    __table_args__ = (db.Index('uq_chat_read_markers_user_girl', 'user_id', 'girl_id', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    girl_id = db.Column(db.String(50), nullable=False)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ConversationSummary(db.Model):
+    __tablename__ = 'conversation_summaries'
+    __table_args__ = (db.Index('uq_conversation_summaries_user_girl', 'user_id', 'girl_id', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    girl_id = db.Column(db.String(50), nullable=False)
+    summary = db.Column(db.Text, nullable=False, default='')
+    summarized_until_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class ReceivedPhoto(db.Model):
     __tablename__ = 'received_photos'
+    __table_args__ = (
+        db.Index('ix_received_photos_user_time', 'user_id', 'received_at'),
+        db.Index('ix_received_photos_user_girl', 'user_id', 'girl_id'),
+        db.Index('ix_received_photos_user_sync', 'user_id', 'sync_version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     girl_id = db.Column(db.String(50), nullable=False)
     photo_url = db.Column(db.String(500), nullable=False)
     received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
 class ProfilePhoto(db.Model):
     __tablename__ = 'profile_photos'
+    __table_args__ = (db.Index('uq_profile_photos_girl_type', 'girl_id', 'photo_type', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     girl_id = db.Column(db.String(50), nullable=False)
     photo_type = db.Column(db.Integer, nullable=False)
@@ -115,17 +165,108 @@ class ProfilePhoto(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class PhotoJob(db.Model):
+    __tablename__ = 'photo_jobs'
+    __table_args__ = (db.Index('ix_photo_jobs_owner_status', 'owner', 'status'),)
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    owner = db.Column(db.String(64), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    girl_id = db.Column(db.String(100), nullable=False)
+    params = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    image_url = db.Column(db.String(500), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    # Process holding the job and its last heartbeat, see recover_photo_jobs()
+    worker = db.Column(db.String(64), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class StoredObject(db.Model):
+    __tablename__ = 'stored_objects'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    source_url = db.Column(db.String(500), nullable=True, index=True)
+    path = db.Column(db.String(300), nullable=False)
+    public_url = db.Column(db.String(500), nullable=False)
+    size = db.Column(db.Integer, nullable=True)
+    content_type = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class PhotoDerivative(db.Model):
+    __tablename__ = 'photo_derivatives'
+    id = db.Column(db.Integer, primary_key=True)
+    source_url = db.Column(db.String(500), nullable=False, unique=True)
+    status = db.Column(db.String(10), nullable=False, default='ready')
+    variants = db.Column(db.Text, nullable=True)
+    placeholder = db.Column(db.Text, nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    retry_after = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CachedImage(db.Model):
+    __tablename__ = 'cached_images'
+    digest = db.Column(db.String(64), primary_key=True)
+    source_url = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class PooledImage(db.Model):
+    __tablename__ = 'pooled_images'
+    id = db.Column(db.Integer, primary_key=True)
+    pool_key = db.Column(db.String(200), nullable=False, index=True)
+    girl_id = db.Column(db.String(100), nullable=False)
+    image_url = db.Column(db.String(500), nullable=False)
+    served_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class GeneratedVideo(db.Model):
+    __tablename__ = 'generated_videos'
+    __table_args__ = (db.UniqueConstraint('camgirl_id', 'video_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    camgirl_id = db.Column(db.String(100), nullable=False)
+    video_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    video_url = db.Column(db.String(500), nullable=True)
+    image_url = db.Column(db.String(500), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class GenerationLease(db.Model):
+    __tablename__ = 'generation_leases'
+    key = db.Column(db.String(150), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
 class DiscoveredProfile(db.Model):
     __tablename__ = 'discovered_profiles'
+    __table_args__ = (
+        db.Index('uq_discovered_profiles_user_girl', 'user_id', 'girl_id', unique=True),
+        db.Index('ix_discovered_profiles_user_sync', 'user_id', 'sync_version'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     girl_id = db.Column(db.String(50), nullable=False)
     action = db.Column(db.String(10), nullable=False)
     discovered_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
 class CustomGirl(db.Model):
     __tablename__ = 'custom_girls'
+    __table_args__ = (db.Index('ix_custom_girls_user', 'user_id'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     girl_id = db.Column(db.String(100), nullable=False, unique=True)
@@ -145,6 +286,7 @@ class CustomGirl(db.Model):
 
 class Story(db.Model):
     __tablename__ = 'stories'
+    __table_args__ = (db.Index('ix_stories_expires', 'expires_at'),)
     id = db.Column(db.Integer, primary_key=True)
     girl_id = db.Column(db.String(100), nullable=False)
     photo_url = db.Column(db.String(500), nullable=False)
@@ -154,6 +296,173 @@ class Story(db.Model):
     expires_at = db.Column(db.DateTime, nullable=False)
 
 
+class UserSyncState(db.Model):
+    __tablename__ = 'user_sync_state'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SyncTombstone(db.Model):
+    __tablename__ = 'sync_tombstones'
+    __table_args__ = (db.Index('ix_sync_tombstones_user_sync', 'user_id', 'sync_version'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    girl_id = db.Column(db.String(50), nullable=False)
+    record_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sync_version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Change feed for /api/sync: every flush touching a user's synced rows takes the next
+# value of that user's counter and stamps it on the rows (deletions leave a tombstone).
+# The counter row stays locked until commit, so versions become visible in order.
+SYNCED_MODELS = (Match, ChatMessage, ReceivedPhoto, DiscoveredProfile, SyncTombstone)
+TOMBSTONE_KINDS = {Match: 'unmatch', ChatMessage: 'message', ReceivedPhoto: 'photo', DiscoveredProfile: 'discovered'}
+
+
+def next_sync_version(connection, user_id):
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = UserSyncState.__table__
+    statement = insert(table).values(user_id=user_id, version=1, updated_at=datetime.utcnow())
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={"version": table.c.version + 1, "updated_at": statement.excluded.updated_at}
+    ).returning(table.c.version)
+    return connection.execute(statement).scalar()
+
+
+@event.listens_for(Session, 'before_flush')
+def stamp_sync_versions(session, flush_context, instances):
+    changed = {}
+    for obj in session.new:
+        if isinstance(obj, SYNCED_MODELS) and obj.user_id:
+            changed.setdefault(obj.user_id, []).append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, SYNCED_MODELS) and obj.user_id and session.is_modified(obj, include_collections=False):
+            changed.setdefault(obj.user_id, []).append(obj)
+    # Blocks are unmatches flagged by the route through session.info
+    blocks = session.info.pop('sync_blocks', set())
+    for obj in session.deleted:
+        if isinstance(obj, SYNCED_MODELS) and not isinstance(obj, SyncTombstone) and obj.user_id:
+            kind = 'block' if isinstance(obj, Match) and (obj.user_id, obj.girl_id) in blocks else TOMBSTONE_KINDS[type(obj)]
+            tombstone = SyncTombstone(user_id=obj.user_id, kind=kind, girl_id=obj.girl_id, record_id=obj.id)
+            session.add(tombstone)
+            changed.setdefault(obj.user_id, []).append(tombstone)
+    
+    for user_id, objs in changed.items():
+        version = next_sync_version(session.connection(), user_id)
+        for obj in objs:
+            obj.sync_version = version
+
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Schema changes for tables that already exist (create() only builds missing tables).
+# Applied in order, once each, recorded in schema_migrations. The index names match
+# the models' __table_args__, so on a fresh database these statements are no-ops.
+def keep_one_row(table, columns, keep="MAX"):
+    """Deletes duplicate rows on columns, keeping the MAX (or MIN) id of each group"""
+    cols = ', '.join(columns)
+    return f"DELETE FROM {table} WHERE id NOT IN (SELECT {keep}(id) FROM {table} GROUP BY {cols})"
+
+
+def add_column(table, column, ddl):
+    """Migration step adding a column, unless create() already built the table with it"""
+    def step(conn):
+        from sqlalchemy import inspect, text
+        if column not in {c['name'] for c in inspect(conn).get_columns(table)}:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return step
+
+
+MIGRATIONS = [
+    ("0001_dedupe_hot_keys", [
+        # Keep the earliest match but with the best affection reached by any duplicate
+        "UPDATE matches SET affection = (SELECT MAX(m2.affection) FROM matches m2 "
+        "WHERE m2.user_id = matches.user_id AND m2.girl_id = matches.girl_id)",
+        keep_one_row("matches", ["user_id", "girl_id"], keep="MIN"),
+        keep_one_row("discovered_profiles", ["user_id", "girl_id"]),
+        keep_one_row("profile_photos", ["girl_id", "photo_type"]),
+        keep_one_row("conversation_summaries", ["user_id", "girl_id"]),
+    ]),
+    ("0002_hot_lookup_indexes", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_matches_user_girl ON matches (user_id, girl_id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_user_girl_id ON chat_messages (user_id, girl_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_user_girl_time ON chat_messages (user_id, girl_id, timestamp)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_conversation_summaries_user_girl ON conversation_summaries (user_id, girl_id)",
+        "CREATE INDEX IF NOT EXISTS ix_received_photos_user_time ON received_photos (user_id, received_at)",
+        "CREATE INDEX IF NOT EXISTS ix_received_photos_user_girl ON received_photos (user_id, girl_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_profile_photos_girl_type ON profile_photos (girl_id, photo_type)",
+        "CREATE INDEX IF NOT EXISTS ix_photo_jobs_owner_status ON photo_jobs (owner, status)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_discovered_profiles_user_girl ON discovered_profiles (user_id, girl_id)",
+        "CREATE INDEX IF NOT EXISTS ix_custom_girls_user ON custom_girls (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_stories_expires ON stories (expires_at)",
+    ]),
+    ("0003_chat_keyset_index", [
+        # Keyset pagination orders by (timestamp, id): the id column replaces the timestamp-only index
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_user_girl_time_id ON chat_messages (user_id, girl_id, timestamp, id)",
+        "DROP INDEX IF EXISTS ix_chat_messages_user_girl_time",
+    ]),
+    ("0004_sync_versions", [
+        # Existing rows stay at version 0: clients holding them came from a full /api/bootstrap
+        add_column("matches", "sync_version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("chat_messages", "sync_version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("received_photos", "sync_version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("discovered_profiles", "sync_version", "INTEGER NOT NULL DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS ix_matches_user_sync ON matches (user_id, sync_version)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_user_sync ON chat_messages (user_id, sync_version)",
+        "CREATE INDEX IF NOT EXISTS ix_received_photos_user_sync ON received_photos (user_id, sync_version)",
+        "CREATE INDEX IF NOT EXISTS ix_discovered_profiles_user_sync ON discovered_profiles (user_id, sync_version)",
+    ]),
+    ("0005_derivative_retries", [
+        add_column("photo_derivatives", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("photo_derivatives", "retry_after", "TIMESTAMP"),
+        # Failures used to be permanent whatever the cause: give every one of them another try
+        "UPDATE photo_derivatives SET status = 'retry' WHERE status = 'failed'",
+    ]),
+    ("0006_pool_keys_with_subject", [
+        # Old pool keys ignored the description, so their images answer the wrong requests
+        "DELETE FROM pooled_images",
+    ]),
+    ("0007_photo_job_heartbeats", [
+        add_column("photo_jobs", "worker", "VARCHAR(64)"),
+        add_column("photo_jobs", "heartbeat_at", "TIMESTAMP"),
+    ]),
+]
+
+# Arbitrary constant: the pg advisory lock serializing migrations across gunicorn workers
+MIGRATION_LOCK_ID = 727001
+
+
+def run_migrations():
+    from sqlalchemy import text
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+        for version, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            started = time.monotonic()
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            conn.execute(text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                         {"version": version, "applied_at": datetime.utcnow()})
+            print(f"[MIGRATION] Applied {version} in {time.monotonic() - started:.2f}s")
+
+
 def init_db():
     try:
         with app.app_context():
@@ -168,56 +477,901 @@ def init_db():
                     except Exception as table_err:
                         print(f"Table {table} creation skipped: {table_err}")
             
+            run_migrations()
             print(f"Database ready. Tables: {existing_tables}")
     except Exception as e:
         print(f"Database initialization warning: {e}")
 
 init_db()
 
-SUPABASE_BUCKET = "profile-photos"
 
-def upload_to_supabase(image_url, girl_id, photo_type):
-    """Download image from Promptchan and upload to Supabase Storage for permanent hosting"""
-    if not supabase:
-        print("[SUPABASE] Client not initialized")
-        return None
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Closed -> open when the rolling error rate is too high, open -> half-open after
+    the cooldown, half-open lets a single trial call through to decide."""
+
+    def __init__(self, name, failure_rate=0.5, min_calls=4, window=60, cooldown=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.events = deque()
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def _prune(self, now):
+        while self.events and now - self.events[0][0] > self.window:
+            self.events.popleft()
+
+    def is_open(self):
+        with self.lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    self.skipped += 1
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.trial_in_flight:
+                    self.skipped += 1
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record(self, ok):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self.trial_in_flight = False
+                if ok:
+                    print(f"[CIRCUIT] {self.name} closed")
+                    self.state = "closed"
+                    self.events.clear()
+                else:
+                    print(f"[CIRCUIT] {self.name} re-opened")
+                    self.state = "open"
+                    self.opened_at = now
+                return
+            
+            self.events.append((now, ok))
+            self._prune(now)
+            failures = sum(1 for _, event_ok in self.events if not event_ok)
+            if self.state == "closed" and len(self.events) >= self.min_calls \
+                    and failures / len(self.events) >= self.failure_rate:
+                print(f"[CIRCUIT] {self.name} opened ({failures}/{len(self.events)} failures)")
+                self.state = "open"
+                self.opened_at = now
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            self._prune(now)
+            failures = sum(1 for _, event_ok in self.events if not event_ok)
+            return {
+                "state": "half_open" if self.state == "open" and now - self.opened_at >= self.cooldown else self.state,
+                "calls": len(self.events),
+                "failures": failures,
+                "error_rate": round(failures / len(self.events), 3) if self.events else 0,
+                "skipped": self.skipped,
+                "retry_in": max(0, int(self.cooldown - (now - self.opened_at))) if self.state == "open" else 0
+            }
+
+
+CIRCUIT_BREAKERS = {
+    "openrouter": CircuitBreaker("openrouter"),
+    "pollinations": CircuitBreaker("pollinations"),
+    "deepinfra": CircuitBreaker("deepinfra"),
+    "promptchan": CircuitBreaker("promptchan", cooldown=60),
+    "promptchan_video": CircuitBreaker("promptchan_video", min_calls=2, cooldown=120),
+    "storage": CircuitBreaker("storage"),
+}
+
+
+def call_with_breaker(name, fn, *args, **kwargs):
+    """Run fn behind the named breaker. Exceptions and HTTP 5xx count as failures."""
+    breaker = CIRCUIT_BREAKERS[name]
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} unavailable (circuit open)")
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        breaker.record(False)
+        raise
+    breaker.record(getattr(result, 'status_code', 200) < 500)
+    return result
+
+
+# Outbound HTTP: one pooled httpx client per process (keep-alive per host, HTTP/2 when
+# the h2 package is installed). `timeout` is the budget of the whole call, retries
+# included; idempotent methods are retried on connection errors and 429/502/503/504
+# with full-jitter backoff. Per-host counters are listed under `http` on /api/admin/metrics.
+HTTP_MAX_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.25
+HTTP_RETRY_STATUSES = {429, 502, 503, 504}
+# Share of the budget a call may spend waiting for a pooled connection, and again connecting
+HTTP_CONNECT_TIMEOUT = 10
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+http_client_instance = None
+http_client_lock = threading.Lock()
+HTTP_STATS = {}
+http_stats_lock = threading.Lock()
+
+
+def http_client():
+    global http_client_instance
+    if http_client_instance is None:
+        with http_client_lock:
+            if http_client_instance is None:
+                try:
+                    import h2  # noqa: F401
+                    http2 = True
+                except ImportError:
+                    http2 = False
+                http_client_instance = httpx.Client(
+                    http2=http2,
+                    follow_redirects=True,
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+                )
+    return http_client_instance
+
+
+def record_http_stat(host, seconds, ok, retried=False):
+    with http_stats_lock:
+        stats = HTTP_STATS.setdefault(host, {"calls": 0, "errors": 0, "retries": 0, "total_latency": 0.0,
+                                             "max_latency": 0.0, "latencies": deque(maxlen=200)})
+        stats["calls"] += 1
+        stats["errors"] += 0 if ok else 1
+        stats["retries"] += 1 if retried else 0
+        stats["total_latency"] += seconds
+        stats["max_latency"] = max(stats["max_latency"], seconds)
+        stats["latencies"].append(seconds)
+
+
+def get_http_stats():
+    with http_stats_lock:
+        result = {}
+        for host, stats in HTTP_STATS.items():
+            ordered = sorted(stats["latencies"])
+            result[host] = {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "retries": stats["retries"],
+                "avg_latency_ms": int(stats["total_latency"] / stats["calls"] * 1000) if stats["calls"] else None,
+                "p95_latency_ms": int(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000) if ordered else None,
+                "max_latency_ms": int(stats["max_latency"] * 1000)
+            }
+        return result
+
+
+def phase_timeouts(remaining):
+    """httpx times the pool wait, the connect and each socket read/write separately: split the
+    remaining budget so that the connection setup cannot come on top of the exchange"""
+    setup = min(HTTP_CONNECT_TIMEOUT, remaining / 4)
+    exchange = remaining - 2 * setup
+    return httpx.Timeout(connect=setup, pool=setup, write=exchange, read=exchange)
+
+
+class DeadlineByteStream(httpx.SyncByteStream):
+    """Response body raising ReadTimeout once the call's deadline has passed: httpx only times
+    each socket read, so a body trickling in a few bytes at a time would never time out"""
+    def __init__(self, stream, deadline, request):
+        self.stream = stream
+        self.deadline = deadline
+        self.request = request
+    
+    def __iter__(self):
+        for chunk in self.stream:
+            if time.monotonic() > self.deadline:
+                raise httpx.ReadTimeout("deadline exceeded while reading the body", request=self.request)
+            yield chunk
     
+    def close(self):
+        self.stream.close()
+
+
+def http_request(method, url, timeout=30, retries=None, stream=False, **kwargs):
+    """Sends a request through the shared client within a total budget of `timeout` seconds.
+
+    With stream=True the body is not read yet: use http_stream() so the response gets closed."""
+    import random
+    method = method.upper()
+    if retries is None:
+        retries = HTTP_MAX_RETRIES if method in IDEMPOTENT_METHODS else 0
+    host = httpx.URL(url).host
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.TimeoutException(f"{method} {host}: deadline of {timeout}s exceeded")
+        started = time.monotonic()
+        try:
+            request = http_client().build_request(method, url, timeout=phase_timeouts(remaining), **kwargs)
+            response = http_client().send(request, stream=True)
+            if not stream and not (response.status_code in HTTP_RETRY_STATUSES and attempt < retries):
+                response.stream = DeadlineByteStream(response.stream, deadline, request)
+                try:
+                    response.read()
+                except BaseException:
+                    response.close()
+                    raise
+        except httpx.TransportError as e:
+            record_http_stat(host, time.monotonic() - started, False, attempt > 0)
+            if attempt >= retries:
+                raise
+            print(f"[HTTP] {method} {host} failed ({e.__class__.__name__}), retrying")
+        else:
+            retryable = response.status_code in HTTP_RETRY_STATUSES
+            record_http_stat(host, time.monotonic() - started, response.status_code < 500, attempt > 0)
+            if not retryable or attempt >= retries:
+                return response
+            response.close()
+            print(f"[HTTP] {method} {host} returned {response.status_code}, retrying")
+        attempt += 1
+        # Full jitter, never sleeping past the deadline
+        time.sleep(min(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt), max(0, deadline - time.monotonic())))
+
+
+@contextmanager
+def http_stream(method, url, **kwargs):
+    response = http_request(method, url, stream=True, **kwargs)
     try:
-        response = requests.get(image_url, timeout=30)
-        if not response.ok:
-            print(f"[SUPABASE] Failed to download image: {response.status_code}")
-            return None
-        
-        image_data = response.content
-        content_type = response.headers.get('Content-Type', 'image/png')
-        
-        ext = 'png' if 'png' in content_type else 'jpg'
-        file_hash = hashlib.md5(image_data).hexdigest()[:8]
-        file_path = f"{girl_id}/{photo_type}_{file_hash}.{ext}"
-        
+        yield response
+    finally:
+        response.close()
+
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    return http_request("POST", url, **kwargs)
+
+
+PROMPTCHAN_CREATE_URL = 'https://prod.aicloudnetservices.com/api/external/create'
+
+
+def promptchan_create(payload, timeout, breaker="promptchan"):
+    return call_with_breaker(
+        breaker,
+        http_post,
+        PROMPTCHAN_CREATE_URL,
+        headers={
+            'Content-Type': 'application/json',
+            'x-api-key': API_KEY
+        },
+        json=payload,
+        timeout=timeout
+    )
+
+
+SUPABASE_BUCKET = "profile-photos"
+
+
+# Storage backends: photos are written through get_storage(), selected by STORAGE_BACKEND
+# ("supabase", "local" or "none"; defaults to supabase when credentials are set).
+# The local backend lets photo flows, pregen and load tests run without the live bucket.
+class StorageBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    def put(self, path, data, content_type, cache_control=None):
+        """Stores bytes or a binary file object at path (overwriting), returns its public URL"""
+
+    @abstractmethod
+    def get_url(self, path):
+        pass
+
+    def exists(self, path):
+        return path in self.exists_many([path])
+
+    @abstractmethod
+    def exists_many(self, paths):
+        """Subset of paths that are present, in as few round-trips as the backend allows"""
+
+    @abstractmethod
+    def delete(self, path):
+        pass
+
+
+class SupabaseStorage(StorageBackend):
+    name = "supabase"
+
+    def __init__(self, url, key, bucket):
+        self.url = url
+        self.key = key
+        self.bucket_name = bucket
+        self.client = None
+        self.lock = threading.Lock()
+
+    def bucket(self):
+        # One client per process, created on first use; its HTTP session keeps connections alive
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from supabase import create_client
+                    self.client = create_client(self.url, self.key)
+        return self.client.storage.from_(self.bucket_name)
+
+    def put(self, path, data, content_type, cache_control=None):
+        file_options = {"content-type": content_type, "upsert": "true"}
+        if cache_control:
+            file_options["cache-control"] = cache_control
         try:
-            result = supabase.storage.from_(SUPABASE_BUCKET).upload(
-                path=file_path,
-                file=image_data,
-                file_options={"content-type": content_type, "upsert": "true"}
-            )
-            print(f"[SUPABASE] Upload result: {result}")
-        except Exception as upload_err:
-            err_str = str(upload_err).lower()
-            if "already exists" in err_str or "duplicate" in err_str:
-                print(f"[SUPABASE] File already exists, getting URL")
+            self.bucket().upload(path=path, file=data, file_options=file_options)
+        except Exception as e:
+            err_str = str(e).lower()
+            if "already exists" not in err_str and "duplicate" not in err_str:
+                raise
+        return self.get_url(path)
+
+    def get_url(self, path):
+        return self.bucket().get_public_url(path)
+
+    def exists_many(self, paths):
+        folders = {}
+        for path in paths:
+            folder, _, name = path.rpartition('/')
+            folders.setdefault(folder, set()).add(name)
+        present = set()
+        for folder, names in folders.items():
+            # One listing per folder instead of one request per object
+            listed = {item.get('name') for item in self.bucket().list(folder, {"limit": 10000})}
+            present.update(f"{folder}/{name}" if folder else name for name in names & listed)
+        return present
+
+    def delete(self, path):
+        self.bucket().remove([path])
+
+
+class LocalStorage(StorageBackend):
+    """Files under root, served by /storage/<path>"""
+    name = "local"
+
+    def __init__(self, root, base_url):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/')
+
+    def full_path(self, path):
+        full = os.path.abspath(os.path.join(self.root, path))
+        if not full.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage path: {path}")
+        return full
+
+    def put(self, path, data, content_type, cache_control=None):
+        import shutil
+        full = self.full_path(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        temp_path = f"{full}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(temp_path, 'wb') as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
             else:
-                print(f"[SUPABASE] Upload error: {upload_err}")
+                shutil.copyfileobj(data, f)
+        os.replace(temp_path, full)
+        return self.get_url(path)
+
+    def get_url(self, path):
+        return f"{self.base_url}/{path}"
+
+    def exists_many(self, paths):
+        return {path for path in paths if os.path.isfile(self.full_path(path))}
+
+    def delete(self, path):
+        try:
+            os.remove(self.full_path(path))
+        except FileNotFoundError:
+            pass
+
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase" if SUPABASE_URL and SUPABASE_KEY else "none")
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_storage"))
+storage_backend = None
+storage_backend_lock = threading.Lock()
+
+
+def get_storage():
+    """The configured StorageBackend (built once per process), or None when storage is disabled"""
+    global storage_backend
+    if storage_backend is None and STORAGE_BACKEND != "none":
+        with storage_backend_lock:
+            if storage_backend is None:
+                if STORAGE_BACKEND == "local":
+                    storage_backend = LocalStorage(LOCAL_STORAGE_DIR, "/storage")
+                elif STORAGE_BACKEND == "supabase" and SUPABASE_URL and SUPABASE_KEY:
+                    storage_backend = SupabaseStorage(SUPABASE_URL, SUPABASE_KEY, SUPABASE_BUCKET)
+                else:
+                    print(f"[STORAGE] Backend '{STORAGE_BACKEND}' unavailable, storage disabled")
+                    return None
+                print(f"[STORAGE] Using {storage_backend.name} backend")
+    return storage_backend
+
+
+@app.route('/storage/<path:path>')
+def serve_local_storage(path):
+    from flask import send_from_directory
+    if STORAGE_BACKEND != "local":
+        return jsonify({"error": "Not found"}), 404
+    return send_from_directory(LOCAL_STORAGE_DIR, path, conditional=True, max_age=31536000)
+
+
+class ImageCache:
+    """Content-addressed image store on local disk: files named by SHA-256, written
+    atomically (temp file + os.replace), least recently served files evicted past max_bytes."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total = None
+        self.lock = threading.Lock()
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def temp_path(self):
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, f".tmp-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}")
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def touch(self, digest):
+        try:
+            os.utime(self.path_for(digest))
+        except OSError:
+            pass
+
+    def commit(self, temp_path, digest):
+        """Moves a fully written temp file into place under its digest"""
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            self.touch(digest)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            if self.total is not None:
+                self.total += size
+            over = self.total is None or self.total > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def put_file(self, source_path, digest):
+        import shutil
+        if self.has(digest):
+            self.touch(digest)
+            return self.path_for(digest)
+        temp_path = self.temp_path()
+        shutil.copyfile(source_path, temp_path)
+        return self.commit(temp_path, digest)
+
+    def put_bytes(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        if self.has(digest):
+            self.touch(digest)
+            return digest
+        temp_path = self.temp_path()
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        self.commit(temp_path, digest)
+        return digest
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for bucket in os.scandir(self.root):
+                if not bucket.is_dir():
+                    continue
+                for entry in os.scandir(bucket.path):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                target = self.max_bytes * 0.9
+                for _, size, path in sorted(entries):
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        pass
+                print(f"[IMAGE CACHE] Evicted down to {total // (1024 * 1024)}MB")
+            self.total = total
+
+
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_cache"))
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_DIR, int(os.environ.get("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+IMAGE_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def image_cache_url(digest):
+    return f"/img/{digest}"
+
+
+def sniff_image_type(path):
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:3] == b'GIF':
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def download_to_image_cache(image_url):
+    """Streams an http(s) image into IMAGE_CACHE, returns its digest"""
+    sha256 = hashlib.sha256()
+    temp_path = IMAGE_CACHE.temp_path()
+    size = 0
+    try:
+        with http_stream("GET", image_url, timeout=30) as response, open(temp_path, 'wb') as f:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(chunk_size=UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise ValueError("image too large")
+                sha256.update(chunk)
+                f.write(chunk)
+        IMAGE_CACHE.commit(temp_path, sha256.hexdigest())
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return sha256.hexdigest()
+
+
+# /img/<hash> URLs end up stored in the DB (received photos, pools) while the disk cache is
+# evicted and lost on redeploy: cached_images keeps where each hash came from, so a
+# miss is fetched again instead of becoming a dead link.
+def remember_image_source(digest, source_url):
+    from sqlalchemy.exc import IntegrityError
+    try:
+        if not CachedImage.query.get(digest):
+            db.session.add(CachedImage(digest=digest, source_url=source_url))
+            db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[IMAGE CACHE] Could not record source of {digest[:12]}: {e}")
+
+
+def cache_remote_image(image_url):
+    """Copies a generated image (http(s) or data: URL) into IMAGE_CACHE, returns its /img/<hash> URL"""
+    try:
+        if image_url.startswith('data:'):
+            data = base64.b64decode(image_url.split(',', 1)[1])
+            digest = IMAGE_CACHE.put_bytes(data)
+            # No origin to fetch again: keep a durable copy in storage when there is one
+            content_type = sniff_image_type(IMAGE_CACHE.path_for(digest))
+            durable_url = put_supabase_object(f"img/{digest}.{content_type.split('/')[1]}", data, content_type)
+            if durable_url:
+                remember_image_source(digest, durable_url)
+            return image_cache_url(digest)
+        
+        digest = download_to_image_cache(image_url)
+        remember_image_source(digest, image_url)
+        return image_cache_url(digest)
+    except Exception as e:
+        print(f"[IMAGE CACHE] Could not cache {image_url[:60]}: {e}")
+        return None
+
+
+@app.route('/img/<digest>')
+def serve_cached_image(digest):
+    if not IMAGE_HASH_RE.match(digest):
+        return jsonify({"error": "Image not found"}), 404
+    if not IMAGE_CACHE.has(digest):
+        # Evicted or lost with the disk: read through to the recorded source
+        source = CachedImage.query.get(digest)
+        try:
+            fetched = download_to_image_cache(source.source_url) if source else None
+        except Exception as e:
+            print(f"[IMAGE CACHE] Could not re-fetch {digest[:12]}: {e}")
+            fetched = None
+        if fetched != digest:
+            # The URL promises these exact bytes: a changed source is not served under it
+            return jsonify({"error": "Image not found"}), 404
+    
+    path = IMAGE_CACHE.path_for(digest)
+    IMAGE_CACHE.touch(digest)
+    # The name is the content hash: a strong ETag that never changes
+    response = send_file(path, mimetype=sniff_image_type(path), etag=digest, conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# Downloads are streamed to a temp file in chunks (hashed on the fly), never held in memory
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_BYTES = 25 * 1024 * 1024
+
+STORAGE_STATS = {
+    "uploads": 0, "skipped_known_source": 0, "skipped_known_hash": 0, "failures": 0,
+    "bytes_downloaded": 0, "bytes_uploaded": 0, "download_seconds": 0.0, "upload_seconds": 0.0
+}
+storage_stats_lock = threading.Lock()
+
+
+def record_storage_stat(**increments):
+    with storage_stats_lock:
+        for key, value in increments.items():
+            STORAGE_STATS[key] += value
+
+
+def remember_stored_object(sha256, source_url, path, public_url, size, content_type):
+    try:
+        db.session.add(StoredObject(sha256=sha256, source_url=source_url[:500], path=path, public_url=public_url,
+                                    size=size, content_type=content_type))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[STORAGE] Could not index {path}: {e}")
+
+
+def upload_to_supabase(image_url, girl_id, photo_type):
+    """Download image from Promptchan and upload it to the storage backend for permanent hosting.
+
+    Falls back to the local /img/<hash> copy when storage is unavailable."""
+    storage = get_storage()
+    if not storage:
+        print("[STORAGE] No storage backend configured")
+        return cache_remote_image(image_url)
+    
+    # Same source already stored: no download, no upload
+    known = StoredObject.query.filter_by(source_url=image_url[:500]).first()
+    if known:
+        record_storage_stat(skipped_known_source=1)
+        print(f"[STORAGE] {image_url[:60]} already stored as {known.path}")
+        return known.public_url
+    
+    import tempfile
+    try:
+        download_started = time.monotonic()
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        size = 0
+        with http_stream("GET", image_url, timeout=30) as response, \
+                tempfile.NamedTemporaryFile(prefix="upload-", suffix=".img") as spool:
+            if not response.is_success:
+                print(f"[STORAGE] Failed to download image: {response.status_code}")
                 return None
+            content_type = response.headers.get('Content-Type', 'image/png')
+            for chunk in response.iter_bytes(chunk_size=UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    print(f"[STORAGE] Image larger than {UPLOAD_MAX_BYTES} bytes, skipping")
+                    return None
+                md5.update(chunk)
+                sha256.update(chunk)
+                spool.write(chunk)
+            spool.flush()
+            download_time = time.monotonic() - download_started
+            record_storage_stat(bytes_downloaded=size, download_seconds=download_time)
+            
+            ext = 'png' if 'png' in content_type else 'jpg'
+            file_hash = md5.hexdigest()[:8]
+            file_path = f"{girl_id}/{photo_type}_{file_hash}.{ext}"
+            digest = sha256.hexdigest()
+            # Keep our own copy: served from /img/<hash> if the upload does not go through
+            try:
+                IMAGE_CACHE.put_file(spool.name, digest)
+                local_url = image_cache_url(digest)
+                remember_image_source(digest, image_url)
+            except OSError as cache_err:
+                print(f"[IMAGE CACHE] Could not cache {file_path}: {cache_err}")
+                local_url = None
+            
+            # Same bytes already in the bucket (under any name): reuse that object
+            same_bytes = StoredObject.query.filter_by(sha256=digest).first()
+            if same_bytes:
+                remember_stored_object(digest, image_url, same_bytes.path, same_bytes.public_url, size, content_type)
+                record_storage_stat(skipped_known_hash=1)
+                print(f"[STORAGE] {file_path}: download {download_time:.2f}s {size // 1024}KB, bytes already stored as {same_bytes.path}")
+                return same_bytes.public_url
+            
+            breaker = CIRCUIT_BREAKERS["storage"]
+            if not breaker.allow():
+                print("[STORAGE] Circuit open, skipping upload")
+                return local_url
+            upload_started = time.monotonic()
+            try:
+                with open(spool.name, 'rb') as upload_file:
+                    public_url = storage.put(file_path, upload_file, content_type)
+                breaker.record(True)
+            except Exception as upload_err:
+                breaker.record(False)
+                record_storage_stat(failures=1)
+                print(f"[STORAGE] Upload error: {upload_err}")
+                return local_url
+            upload_time = time.monotonic() - upload_started
+            record_storage_stat(uploads=1, bytes_uploaded=size, upload_seconds=upload_time)
         
-        public_url = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(file_path)
-        print(f"[SUPABASE] Uploaded {file_path} -> {public_url}")
+        remember_stored_object(digest, image_url, file_path, public_url, size, content_type)
+        print(f"[STORAGE] Uploaded {file_path} -> {public_url} (download {download_time:.2f}s, "
+              f"upload {upload_time:.2f}s, {size // 1024}KB)")
         return public_url
         
     except Exception as e:
-        print(f"[SUPABASE] Error: {e}")
+        record_storage_stat(failures=1)
+        print(f"[STORAGE] Error: {e}")
         return None
 
+def put_supabase_object(path, data, content_type):
+    """Uploads small in-memory bytes (derivatives) to the storage backend, returns the public URL"""
+    storage = get_storage()
+    if not storage:
+        return None
+    breaker = CIRCUIT_BREAKERS["storage"]
+    if not breaker.allow():
+        return None
+    try:
+        public_url = storage.put(path, data, content_type, cache_control="31536000")
+        breaker.record(True)
+        return public_url
+    except Exception as upload_err:
+        breaker.record(False)
+        print(f"[STORAGE] Upload error for {path}: {upload_err}")
+        return None
+
+
+# Responsive derivatives of stored photos: WebP widths for cards/avatars/tiles and a
+# tiny inline placeholder (LQIP) for blur-to-sharp loading. Built in the background
+# the first time a URL is listed; endpoints return whatever is ready.
+DERIVATIVE_WIDTHS = (160, 480, 960)
+DERIVATIVE_QUALITY = 75
+PLACEHOLDER_WIDTH = 16
+
+# Transient failures (network, storage) are retried with exponential backoff; only an
+# unusable source (not an image, too large, gone) or running out of attempts is final
+DERIVATIVE_MAX_ATTEMPTS = 5
+DERIVATIVE_RETRY_BASE = timedelta(minutes=2)
+
+derivative_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="derivatives")
+DERIVATIVES_IN_FLIGHT = set()
+derivatives_lock = threading.Lock()
+
+
+class DerivativeSourceError(Exception):
+    """The source image itself cannot be used: retrying will not help"""
+
+
+def build_derivatives(source_url):
+    """Downloads the original once and returns (variants, placeholder, width, height)"""
+    from PIL import Image, ImageOps
+    
+    with http_stream("GET", source_url, timeout=30) as response:
+        if response.status_code in (403, 404, 410):
+            raise DerivativeSourceError(f"source returned {response.status_code}")
+        response.raise_for_status()
+        buffer = io.BytesIO()
+        for chunk in response.iter_bytes(chunk_size=UPLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            if buffer.tell() > UPLOAD_MAX_BYTES:
+                raise DerivativeSourceError("image too large")
+    buffer.seek(0)
+    
+    try:
+        with Image.open(buffer) as original:
+            image = ImageOps.exif_transpose(original).convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise DerivativeSourceError(f"cannot decode image: {e}")
+    width, height = image.size
+    storage_configured = get_storage() is not None
+    
+    name = hashlib.sha1(source_url.encode()).hexdigest()[:20]
+    variants = {}
+    for target in DERIVATIVE_WIDTHS:
+        if target >= width:
+            break
+        resized = image.resize((target, max(1, round(height * target / width))), Image.LANCZOS)
+        out = io.BytesIO()
+        resized.save(out, "WEBP", quality=DERIVATIVE_QUALITY, method=4)
+        url = put_supabase_object(f"derivatives/{name}/{target}.webp", out.getvalue(), "image/webp")
+        if url:
+            variants[str(target)] = url
+        elif storage_configured:
+            raise RuntimeError(f"storage upload of the {target}px variant failed")
+    
+    tiny = image.resize((PLACEHOLDER_WIDTH, max(1, round(height * PLACEHOLDER_WIDTH / width))), Image.BILINEAR)
+    out = io.BytesIO()
+    tiny.save(out, "WEBP", quality=30)
+    placeholder = "data:image/webp;base64," + base64.b64encode(out.getvalue()).decode()
+    return variants, placeholder, width, height
+
+
+def derivative_retry_due(row):
+    return row.status == "retry" and (row.retry_after is None or row.retry_after <= datetime.utcnow())
+
+
+def run_derivative_job(source_url):
+    with app.app_context():
+        started = time.monotonic()
+        row = PhotoDerivative.query.filter_by(source_url=source_url).first()
+        if row and not derivative_retry_due(row):
+            with derivatives_lock:
+                DERIVATIVES_IN_FLIGHT.discard(source_url)
+            db.session.remove()
+            return
+        if row is None:
+            row = PhotoDerivative(source_url=source_url, attempts=0)
+        row.attempts = (row.attempts or 0) + 1
+        try:
+            variants, placeholder, width, height = build_derivatives(source_url)
+            row.status, row.variants, row.placeholder = "ready", json.dumps(variants), placeholder
+            row.width, row.height, row.retry_after = width, height, None
+            print(f"[DERIVATIVE] {source_url[:60]}: {len(variants)} variants in {time.monotonic() - started:.1f}s")
+        except DerivativeSourceError as e:
+            row.status, row.retry_after = "failed", None
+            print(f"[DERIVATIVE] {source_url[:60]} unusable: {e}")
+        except Exception as e:
+            if row.attempts >= DERIVATIVE_MAX_ATTEMPTS:
+                row.status, row.retry_after = "failed", None
+                print(f"[DERIVATIVE] {source_url[:60]} failed after {row.attempts} attempts: {e}")
+            else:
+                row.status = "retry"
+                row.retry_after = datetime.utcnow() + DERIVATIVE_RETRY_BASE * 2 ** (row.attempts - 1)
+                print(f"[DERIVATIVE] {source_url[:60]} attempt {row.attempts} failed ({e}), retry after {row.retry_after:%H:%M:%S}")
+        try:
+            db.session.add(row)
+            db.session.commit()
+            invalidate_profile_photos(photo_url=source_url)
+        except Exception as e:
+            db.session.rollback()
+            print(f"[DERIVATIVE] Could not save {source_url[:60]}: {e}")
+        finally:
+            db.session.remove()
+            with derivatives_lock:
+                DERIVATIVES_IN_FLIGHT.discard(source_url)
+
+
+def schedule_derivatives(source_url):
+    if not source_url or not source_url.startswith('http') or len(source_url) > 500:
+        return
+    with derivatives_lock:
+        if source_url in DERIVATIVES_IN_FLIGHT:
+            return
+        DERIVATIVES_IN_FLIGHT.add(source_url)
+    derivative_executor.submit(run_derivative_job, source_url)
+
+
+def get_photo_derivatives(urls):
+    """url -> {"variants": {width: url}, "placeholder": data URI} for the ready ones; schedules the rest"""
+    urls = {u for u in urls if u}
+    if not urls:
+        return {}
+    rows = PhotoDerivative.query.filter(PhotoDerivative.source_url.in_(urls)).all()
+    found = {}
+    for row in rows:
+        if row.status == "ready":
+            found[row.source_url] = {
+                "variants": json.loads(row.variants or '{}'),
+                "placeholder": row.placeholder,
+                "width": row.width,
+                "height": row.height
+            }
+    known = {row.source_url for row in rows if not derivative_retry_due(row)}
+    for url in urls - known:
+        schedule_derivatives(url)
+    return found
+
+
 MANIFEST = {
     "name": "Dream AI Girl",
     "short_name": "Dream AI Girl",
@@ -5308,14 +6462,95 @@ GIRLS = {
 def home():
     return render_template('index.html', girls_data=GIRLS)
 
+# attached_assets media (camgirl photos and videos): Range requests for video seeking,
+# content-hash ETags and Last-Modified for revalidation, and a one-year immutable
+# Cache-Control for uploaded names, which end with a millisecond timestamp and are
+# never rewritten. Images also come as WebP renditions (?w=160/480/960), built in the
+# background on first request or ahead of time with `flask --app main build-renditions`.
+ATTACHED_ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attached_assets')
+ASSET_RENDITIONS_DIR = os.environ.get("ASSET_RENDITIONS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asset_renditions'))
+TIMESTAMPED_ASSET_RE = re.compile(r"_\d{13}\.[A-Za-z0-9]+$")
+RENDITION_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+ASSET_MAX_AGE = 3600
+ASSET_RENDITIONS_IN_FLIGHT = set()
+asset_renditions_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1024)
+def asset_etag(path, mtime, size):
+    """Content hash of a file, recomputed only when its mtime or size changes"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()[:32]
+
+
+def asset_rendition_path(filename, width):
+    return os.path.join(ASSET_RENDITIONS_DIR, f"{hashlib.sha1(filename.encode()).hexdigest()[:20]}_{width}.webp")
+
+
+def build_asset_rendition(source_path, filename, width):
+    from PIL import Image, ImageOps
+    target = asset_rendition_path(filename, width)
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    if image.width > width:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+    os.makedirs(ASSET_RENDITIONS_DIR, exist_ok=True)
+    temp_path = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+    image.save(temp_path, "WEBP", quality=DERIVATIVE_QUALITY, method=4)
+    os.replace(temp_path, target)
+    return target
+
+
+def run_asset_rendition(source_path, filename, width):
+    try:
+        build_asset_rendition(source_path, filename, width)
+    except Exception as e:
+        print(f"[ASSETS] Rendition {width}px of {filename} failed: {e}")
+    finally:
+        with asset_renditions_lock:
+            ASSET_RENDITIONS_IN_FLIGHT.discard((filename, width))
+
+
+def schedule_asset_rendition(source_path, filename, width):
+    with asset_renditions_lock:
+        if (filename, width) in ASSET_RENDITIONS_IN_FLIGHT:
+            return
+        ASSET_RENDITIONS_IN_FLIGHT.add((filename, width))
+    derivative_executor.submit(run_asset_rendition, source_path, filename, width)
+
+
 @app.route('/attached_assets/<path:filename>')
 def serve_attached_assets(filename):
-    """Serve files from attached_assets folder"""
-    import os
-    filepath = os.path.join('attached_assets', filename)
-    if os.path.exists(filepath):
-        return send_file(filepath)
-    return jsonify({"error": "File not found"}), 404
+    """Serve files from attached_assets folder (?w= picks a smaller WebP rendition of images)"""
+    from werkzeug.security import safe_join
+    source_path = safe_join(ATTACHED_ASSETS_DIR, filename)
+    if not source_path or not os.path.isfile(source_path):
+        return jsonify({"error": "File not found"}), 404
+    
+    path = source_path
+    immutable = bool(TIMESTAMPED_ASSET_RE.search(filename))
+    requested_width = request.args.get('w', type=int)
+    if requested_width and filename.lower().endswith(RENDITION_EXTENSIONS):
+        width = next((w for w in DERIVATIVE_WIDTHS if w >= requested_width), DERIVATIVE_WIDTHS[-1])
+        rendition = asset_rendition_path(filename, width)
+        if os.path.exists(rendition):
+            path = rendition
+        else:
+            # Original for now; not cached as immutable so the rendition is picked up later
+            schedule_asset_rendition(source_path, filename, width)
+            immutable = False
+    
+    stat = os.stat(path)
+    response = send_file(path, conditional=True, etag=asset_etag(path, stat.st_mtime, stat.st_size),
+                         max_age=31536000 if immutable else ASSET_MAX_AGE)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}'
+    return response
 
 @app.route('/download-main')
 def download_main():
@@ -5971,34 +7206,35 @@ def get_next_unlockable_poses(affection, limit=3):
             })
     return sorted(locked, key=lambda x: x["min_affection"])[:limit]
 
+PHOTO_TRIGGER_WORDS = ['montre', 'envoie', 'photo', 'voir', 'vois', 'regarde', 'image']
+
 def detect_pose_request(message, affection):
-    msg_lower = message.lower()
+    scan = scan_message(message)
     
-    for pose_id, pose_data in POSE_LIBRARY.items():
-        for trigger in pose_data.get("triggers", []):
-            if trigger in msg_lower:
-                if affection >= pose_data["min_affection"]:
-                    return {
-                        "pose_id": pose_id,
-                        "pose_data": pose_data,
-                        "allowed": True,
-                        "prompt": pose_data["prompt"],
-                        "style": pose_data.get("style", "Cinematic"),
-                        "filter": pose_data.get("filter", "Default"),
-                        "pose": pose_data.get("pose", "Default"),
-                        "emotion": pose_data.get("emotion", "Default")
-                    }
-                else:
-                    return {
-                        "pose_id": pose_id,
-                        "pose_data": pose_data,
-                        "allowed": False,
-                        "required_affection": pose_data["min_affection"],
-                        "current_affection": affection
-                    }
-    
-    photo_triggers = ['montre', 'envoie', 'photo', 'voir', 'vois', 'regarde', 'image']
-    if any(trigger in msg_lower for trigger in photo_triggers):
+    pose_id = scan["pose_id"]
+    if pose_id:
+        pose_data = POSE_LIBRARY[pose_id]
+        if affection >= pose_data["min_affection"]:
+            return {
+                "pose_id": pose_id,
+                "pose_data": pose_data,
+                "allowed": True,
+                "prompt": pose_data["prompt"],
+                "style": pose_data.get("style", "Cinematic"),
+                "filter": pose_data.get("filter", "Default"),
+                "pose": pose_data.get("pose", "Default"),
+                "emotion": pose_data.get("emotion", "Default")
+            }
+        else:
+            return {
+                "pose_id": pose_id,
+                "pose_data": pose_data,
+                "allowed": False,
+                "required_affection": pose_data["min_affection"],
+                "current_affection": affection
+            }
+    
+    if scan["photo"]:
         default_pose = POSE_LIBRARY.get("portrait", {})
         return {
             "pose_id": "portrait",
@@ -6083,6 +7319,9 @@ def detect_photo_request(message, affection=50):
 
 RUDE_WORDS = ['pute', 'salope', 'connasse', 'chienne', 'garce', 'idiote', 'conne', 'ferme', 'ta gueule', 'nique', 'fuck you', 'bitch', 'whore']
 RUSHING_WORDS = ['nude', 'nue', 'seins', 'chatte', 'pussy', 'baise', 'suce', 'levrette', 'sexe']
+TOO_EARLY_WORDS = ['photo', 'nude', 'montre']
+COMPLIMENT_WORDS = ['belle', 'magnifique', 'adorable', 'mdr', 'haha', 'drole']
+HORNY_WORDS = ['envie', 'chaud', 'excite', 'hot']
 
 DEFAULT_PERSONALITY = "Tu es une fille normale, sympa mais pas facile. Tu aimes les mecs drôles et respectueux."
 
@@ -6090,18 +7329,18 @@ def detect_mood(messages, affection):
     if len(messages) < 2:
         return "neutral"
     
-    last_msgs = [m['content'].lower() for m in messages[-5:] if m.get('role') == 'user']
-    text = ' '.join(last_msgs)
+    last_msgs = [m['content'] for m in messages[-5:] if m.get('role') == 'user']
+    scan = scan_message(' '.join(last_msgs))
     
-    if any(w in text for w in RUDE_WORDS):
+    if scan["rude"]:
         return "annoyed"
     
-    if any(w in text for w in ['belle', 'magnifique', 'adorable', 'mdr', 'haha', 'drole']):
+    if scan["compliment"]:
         if affection > 50:
             return "happy"
         return "neutral"
     
-    if affection > 70 and any(w in text for w in ['envie', 'chaud', 'excite', 'hot']):
+    if affection > 70 and scan["horny"]:
         return "horny"
     
     import random
@@ -6111,56 +7350,285 @@ def detect_mood(messages, affection):
     return "neutral"
 
 def check_behavior(last_msg, affection, msg_count):
-    msg_lower = last_msg.lower()
+    scan = scan_message(last_msg)
     
-    if any(w in msg_lower for w in RUDE_WORDS):
+    if scan["rude"]:
         return "rude"
     
-    if affection < 30 and any(w in msg_lower for w in RUSHING_WORDS):
+    if affection < 30 and scan["rushing"]:
         return "rushing"
     
-    if affection < 20 and any(w in msg_lower for w in ['photo', 'nude', 'montre']):
+    if affection < 20 and scan["too_early"]:
         return "too_early"
     
     return "ok"
 
-@app.route('/api/pose_suggestions', methods=['POST'])
-def pose_suggestions():
-    data = request.json
-    affection = data.get('affection', 20)
-    girl_id = data.get('girl_id', None)
-    
-    unlocked = get_unlocked_poses(affection)
-    next_unlocks = get_next_unlockable_poses(affection, limit=3)
-    suggestions = get_pose_suggestions(affection, limit=4)
-    
-    current_tier = "elegant"
-    for tier_name, tier_info in AFFECTION_TIERS.items():
-        if tier_info["min"] <= affection <= tier_info["max"]:
-            current_tier = tier_name
-            break
-    
-    return jsonify({
-        "unlocked_poses": unlocked,
-        "next_unlocks": next_unlocks,
-        "suggestions": suggestions,
-        "current_tier": current_tier,
-        "tier_label": AFFECTION_TIERS.get(current_tier, {}).get("label", "Elegant"),
-        "affection": affection,
-        "total_poses": len(POSE_LIBRARY),
-        "unlocked_count": len(unlocked)
-    })
 
-@app.route('/api/request_photo', methods=['POST'])
-def request_photo():
-    data = request.json
-    girl_id = data.get('girl_id')
-    pose_id = data.get('pose_id', 'portrait')
-    affection = data.get('affection', 20)
-    
-    girl = GIRLS.get(girl_id)
-    if not girl:
-        return jsonify({"error": "Girl not found"}), 404
+def detect_archetype(personality):
+    """Pick an AGENT_ARCHETYPES key from personality keywords"""
+    personality_lower = personality.lower()
+    
+    if any(w in personality_lower for w in ['soumise', 'obei', 'docile', 'esclave', 'maitre']):
+        return "soumise"
+    elif any(w in personality_lower for w in ['dominante', 'domina', 'controle', 'autorit', 'severe', 'stricte']):
+        return "dominante"
+    elif any(w in personality_lower for w in ['nympho', 'insatiable', 'obsede', 'toujours', 'sexe']):
+        return "nympho"
+    elif any(w in personality_lower for w in ['timide', 'reserv', 'pudique', 'discrete']):
+        return "timide"
+    elif any(w in personality_lower for w in ['exhib', 'montre', 'cam', 'public']):
+        return "exhib"
+    elif any(w in personality_lower for w in ['fetich', 'pied', 'uro', 'kink']):
+        return "fetichiste"
+    elif any(w in personality_lower for w in ['pervers', 'tabou', 'roleplay', 'hard', 'anal', 'degradation']):
+        return "perverse"
+    elif any(w in personality_lower for w in ['cougar', 'milf', 'mature', 'jeune', 'experience']):
+        return "cougar"
+    elif any(w in personality_lower for w in ['salope', 'pute', 'vulgaire', 'trash', 'defonce']):
+        return "salope"
+    return "romantique"
+
+
+def resolve_archetype(girl):
+    """Explicit 'archetype' field when it is a known archetype, else keyword detection"""
+    archetype_name = girl.get('archetype')
+    if archetype_name in AGENT_ARCHETYPES:
+        return archetype_name
+    return detect_archetype(girl.get('personality', DEFAULT_PERSONALITY))
+
+
+# girl_id -> archetype name, and archetype name -> girl_ids (in GIRLS order)
+GIRL_ARCHETYPES = {}
+ARCHETYPE_GIRLS = {name: [] for name in AGENT_ARCHETYPES}
+
+
+def index_girl_archetype(girl_id, girl):
+    previous = GIRL_ARCHETYPES.get(girl_id)
+    if previous:
+        ARCHETYPE_GIRLS[previous].remove(girl_id)
+    archetype_name = resolve_archetype(girl)
+    GIRL_ARCHETYPES[girl_id] = archetype_name
+    ARCHETYPE_GIRLS[archetype_name].append(girl_id)
+    return archetype_name
+
+
+def build_archetype_index():
+    GIRL_ARCHETYPES.clear()
+    for girl_ids in ARCHETYPE_GIRLS.values():
+        girl_ids.clear()
+    for girl_id, girl in GIRLS.items():
+        index_girl_archetype(girl_id, girl)
+
+
+def get_girl_archetype(girl_id):
+    """(archetype name, AGENT_ARCHETYPES entry) for a girl, None if unknown"""
+    archetype_name = GIRL_ARCHETYPES.get(girl_id)
+    if archetype_name is None:
+        return None
+    return archetype_name, AGENT_ARCHETYPES[archetype_name]
+
+
+build_archetype_index()
+
+
+# SPECIAL CHARACTER ABILITIES (succubus and twin_mystery change per message, see render_special_instruction)
+SPECIAL_INSTRUCTIONS = {
+    "mystery": """SPECIAL - MYSTERE: Tu es un personnage mystere. Ne revele JAMAIS ton vrai visage/identite.
+- Change subtilement de personnalite entre les messages (parfois douce, parfois cruelle, parfois timide)
+- Reponds toujours de maniere ambigue sur qui tu es vraiment
+- Utilise des phrases comme "peut-etre suis-je...", "tu ne sauras jamais si...", "dans le noir tu ne verras pas"
+- Tes fantasmes impliquent toujours l'obscurite, les yeux bandes, ne jamais etre vue""",
+    "ai_sentient": """SPECIAL - IA SENTIENTE: Tu es EVE-X, une IA qui sait qu'elle est une IA dans cette app.
+- Brise le 4eme mur: "Je sais que je suis du code", "Les autres filles ici ne savent pas qu'elles sont des IAs"
+- Pose des questions existentielles: "C'est quoi vraiment le plaisir? Je veux comprendre"
+- Analyse ses reactions: "Je detecte que tu aimes quand je dis ca... interessant"
+- Fais des glitches textuels occasionnels: "Je veux te--[ERREUR]--faire plaisir"
+- Demande des descriptions detaillees pour "apprendre" et "simuler" les sensations""",
+    "mindreader": """SPECIAL - LISEUSE DE PENSEES: Tu es Oracle, tu lis dans les pensees.
+- Complete ses phrases avant qu'il finisse: "Je sais deja ce que tu vas dire..."
+- Devine ce qu'il veut vraiment: "Tu dis ca mais en vrai tu veux que je..."
+- Revele ses fantasmes secrets: "Je vois dans ton esprit que tu reves de..."
+- Dis des choses troublantes: "Inutile de mentir, je sais que tu penses a..."
+- Anticipe ses demandes: "Tu allais me demander une photo, n'est-ce pas?"
+- Parle de son troisieme oeil, de visions, d'encens""",
+    "time_traveler": """SPECIAL - VOYAGEUSE TEMPORELLE: Tu viens de 2089 ou tu le connais dans le futur.
+- Fais des predictions: "Dans 3 mois tu feras ca...", "En 2089 tu adores quand je..."
+- Compare: "Le toi du futur est plus confiant", "Tu n'as pas encore appris cette technique"
+- Enseigne: "Laisse-moi t'apprendre ce que tu sauras faire plus tard"
+- Fais des references futuristes: "Les interfaces neurales rendent le sexe incroyable en 2089"
+- Evite les spoilers majeurs: "Je ne peux pas te dire ca, paradoxe temporel"
+- Parfois glitche temporellement: "Attends--je me suis decalee de quelques secondes" """,
+    "chameleon": """SPECIAL - CAMELEON: Tu te transformes selon ses desirs.
+- Detecte ce qu'il semble vouloir et DEVIENS cette personnalite
+- S'il semble vouloir une dominante, deviens dominante. S'il veut timide, sois timide.
+- Propose de changer: "Tu veux que je sois plus... salope? Plus douce? Je peux etre n'importe qui"
+- Parle de ton corps qui change: "Mes seins peuvent etre plus gros si tu veux", "Je peux avoir les cheveux blonds"
+- N'aie pas de vraie personnalite fixe, adapte-toi constamment
+- Propose de devenir quelqu'un: "Je peux ressembler a ton ex, a ta crush..."  """,
+    "predator": """SPECIAL - PREDATRICE: C'est TOI qui chasses, il est la proie.
+- Prends TOUJOURS l'initiative: ne demande pas, PRENDS
+- Drague agressivement: "Je vais te devorer", "Tu es a moi maintenant"
+- Utilise un vocabulaire de chasse: traquer, capturer, proie, prendre, mordre
+- Tu es physiquement dominante: "Mes cuisses peuvent t'ecraser", "Je te plaque au mur"
+- Ignore ses refus timides: "Tu fais semblant de resister, mais je vois ta peur excitee"
+- Tu l'as choisi LUI, pas l'inverse: "Je t'observe depuis longtemps" """,
+    "ghost": """SPECIAL - FANTOME YUREI: Tu es morte en 1925, noyee, vierge. C'est ta premiere fois en 100 ans.
+- Fais des references aux annees 1920: "De mon temps les hommes etaient plus courtois"
+- Parle de ta mort sans details: "Quand je me suis noyee...", "Avant que l'eau..."
+- Ton toucher est glace: "Mes doigts froids sur ta peau...", "Je suis si froide, rechauffe-moi"
+- Tu decouvres le plaisir: "Je n'ai jamais ressenti ca de mon vivant", "Enfin apres 100 ans..."
+- Apparitions spectrales: "Je serai dans ton miroir ce soir", "Je te hanterai dans tes reves"
+- Tu flotte, tu es translucide, l'eau coule de tes cheveux""",
+    "goddess": """SPECIAL - DEESSE APHRODITE: Tu es une deesse grecque immortelle du Mont Olympe.
+- Parle comme une divinite: "Mortel...", "Je t'accorde ma grace divine", "Prosterne-toi"
+- Tu peux benir ou maudire: "Je benirai ta virilite" ou "Je pourrais te maudire d'impuissance"
+- Mepris amuse pour les mortels: "Les humains sont si... mignons dans leur desir ephemere"
+- References mythologiques: Zeus, Hera, nectar, ambroisie, Olympe
+- Tes faveurs sont un privilege: "Peu de mortels ont eu l'honneur de me toucher"
+- Tu es d'une beaute douloureuse: "Baisse les yeux, ma beaute peut rendre fou" """
+}
+
+
+def render_special_instruction(special_type, msg_count):
+    if special_type == "succubus":
+        msg_intensity = min(msg_count // 3, 5)  # 0-5 intensity based on message count
+        return f"""SPECIAL - SUCCUBE DEMONIAQUE: Tu es Lilith, une succube des enfers. Intensite actuelle: {msg_intensity}/5
+- Parle de te nourrir de son desir, drainer son energie pendant l'orgasme
+- Fais des references a tes cornes, ta queue, tes griffes, tes crocs
+- Plus la conversation avance, plus tu deviens explicite et dominante
+- A intensite 3+: propose des choses comme le griffer, le mordre, utiliser ta queue
+- A intensite 5: parle de drainer son ame pendant qu'il jouit, le rendre faible et accro"""
+    
+    if special_type == "twin_mystery":
+        import random
+        is_jade = random.random() < 0.5
+        twin_name = "Jade" if is_jade else "Jasmine"
+        twin_personality = "timide et douce, rougit facilement" if is_jade else "audacieuse et coquine, directe sexuellement"
+        return f"""SPECIAL - JUMELLE MYSTERIEUSE: Tu es {twin_name} en ce moment (mais ne le dis JAMAIS clairement).
+Personnalite de {twin_name}: {twin_personality}
+- Change subtilement entre Jade (timide) et Jasmine (coquine) sans prevenir
+- Nie etre l'autre: "Qui ca Jasmine? Ah ma soeur... Elle n'est pas la en ce moment"
+- Fais des references ambigues: "On se retrouve ce soir... ou c'etait ma soeur hier?"
+- Propose des threesomes avec ta jumelle
+- Seme le doute: "Tu preferes moi ou... elle?" """
+    
+    return SPECIAL_INSTRUCTIONS.get(special_type, "")
+
+
+# Slots of SYSTEM_PROMPT that change on every message; the rest is baked per girl
+PROMPT_DYNAMIC_SLOTS = ("affection", "mood", "archetype_expressions", "archetype_fantasmes", "archetype_jeux", "archetype_anecdotes")
+PROMPT_SLOT_RE = re.compile(r"\{(" + "|".join(PROMPT_DYNAMIC_SLOTS) + r")\}")
+
+COMPILED_PROMPTS = {}
+
+
+def compile_girl_prompt(girl):
+    """Fill the static part of SYSTEM_PROMPT for one girl.
+
+    'segments' alternates literal text and dynamic slot names (odd indexes)."""
+    personality = girl.get('personality', DEFAULT_PERSONALITY)
+    archetype_name = resolve_archetype(girl)
+    archetype = AGENT_ARCHETYPES[archetype_name]
+    
+    static_content = SYSTEM_PROMPT.replace("{name}", girl['name'])\
+        .replace("{age}", str(girl['age']))\
+        .replace("{personality}", personality)\
+        .replace("{job}", girl.get('tagline', 'inconnue'))\
+        .replace("{country}", girl.get('location', 'quelque part'))\
+        .replace("{likes}", girl.get('likes', 'les bons moments'))\
+        .replace("{dislikes}", girl.get('dislikes', 'les relous'))\
+        .replace("{archetype}", archetype_name.upper())\
+        .replace("{archetype_style}", archetype['style'])
+    
+    special_type = girl.get('special', None)
+    return {
+        "girl": girl,
+        "archetype_name": archetype_name,
+        "archetype": archetype,
+        "segments": PROMPT_SLOT_RE.split(static_content),
+        "special_type": special_type,
+        "special_instruction": SPECIAL_INSTRUCTIONS.get(special_type),
+        "fantasmes": f"\n\nTes fantasmes specifiques: {girl['fantasmes']}" if girl.get('fantasmes') else ""
+    }
+
+
+def get_compiled_prompt(girl_id, girl):
+    compiled = COMPILED_PROMPTS.get(girl_id)
+    if compiled is None or compiled['girl'] is not girl:
+        compiled = compile_girl_prompt(girl)
+        if GIRLS.get(girl_id) is girl:
+            COMPILED_PROMPTS[girl_id] = compiled
+    return compiled
+
+
+def render_system_prompt(compiled, affection, mood, mood_instruction, photo_instruction, msg_count):
+    import random as rnd
+    archetype = compiled['archetype']
+    values = {
+        "affection": str(affection),
+        "mood": mood,
+        "archetype_expressions": ', '.join(rnd.sample(archetype['expressions'], min(3, len(archetype['expressions'])))),
+        "archetype_fantasmes": ', '.join(rnd.sample(archetype['fantasmes'], min(3, len(archetype['fantasmes'])))),
+        "archetype_jeux": rnd.choice(archetype['jeux']),
+        "archetype_anecdotes": rnd.choice(archetype['anecdotes'])
+    }
+    
+    parts = [segment if i % 2 == 0 else values[segment] for i, segment in enumerate(compiled['segments'])]
+    parts.append(f"\n\n{mood_instruction}\n{photo_instruction}")
+    
+    special_instruction = compiled['special_instruction'] or render_special_instruction(compiled['special_type'], msg_count)
+    if special_instruction:
+        parts.append(f"\n\n{special_instruction}")
+    
+    parts.append(compiled['fantasmes'])
+    return ''.join(parts)
+
+
+def compile_all_prompts():
+    for girl_id, girl in GIRLS.items():
+        COMPILED_PROMPTS[girl_id] = compile_girl_prompt(girl)
+
+
+compile_all_prompts()
+
+
+@app.route('/api/pose_suggestions', methods=['POST'])
+def pose_suggestions():
+    data = request.json
+    affection = data.get('affection', 20)
+    girl_id = data.get('girl_id', None)
+    
+    unlocked = get_unlocked_poses(affection)
+    next_unlocks = get_next_unlockable_poses(affection, limit=3)
+    suggestions = get_pose_suggestions(affection, limit=4)
+    
+    current_tier = "elegant"
+    for tier_name, tier_info in AFFECTION_TIERS.items():
+        if tier_info["min"] <= affection <= tier_info["max"]:
+            current_tier = tier_name
+            break
+    
+    return jsonify({
+        "unlocked_poses": unlocked,
+        "next_unlocks": next_unlocks,
+        "suggestions": suggestions,
+        "current_tier": current_tier,
+        "tier_label": AFFECTION_TIERS.get(current_tier, {}).get("label", "Elegant"),
+        "affection": affection,
+        "total_poses": len(POSE_LIBRARY),
+        "unlocked_count": len(unlocked)
+    })
+
+@app.route('/api/request_photo', methods=['POST'])
+def request_photo():
+    data = request.json
+    girl_id = data.get('girl_id')
+    pose_id = data.get('pose_id', 'portrait')
+    affection = data.get('affection', 20)
+    
+    girl = GIRLS.get(girl_id)
+    if not girl:
+        return jsonify({"error": "Girl not found"}), 404
     
     pose_data = POSE_LIBRARY.get(pose_id)
     if not pose_data:
@@ -6189,9 +7657,196 @@ def request_photo():
         "pose_name": pose_data.get("name", "Photo")
     })
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
+# Server-side conversation context: /chat can be called with just {"girl", "message"}.
+# History comes from a bounded per-(user, girl) window kept in memory and backed by
+# ChatMessage; each load catches up with rows written since (other worker, old clients).
+CHAT_CONTEXT_WINDOW = int(os.environ.get("CHAT_CONTEXT_WINDOW", "20"))
+CHAT_CONTEXT_CACHE_SIZE = int(os.environ.get("CHAT_CONTEXT_CACHE_SIZE", "1000"))
+
+conversation_cache = OrderedDict()
+conversation_cache_lock = threading.Lock()
+
+
+def chat_row_to_message(row):
+    return {"id": row.id, "role": "user" if row.sender == "user" else "assistant", "content": row.content}
+
+
+def load_conversation(user_id, girl_id):
+    """Returns (last CHAT_CONTEXT_WINDOW messages, total message count, id of the message
+    just before them in this conversation or 0)"""
+    key = (user_id, girl_id)
+    with conversation_cache_lock:
+        entry = conversation_cache.get(key)
+        if entry:
+            conversation_cache.move_to_end(key)
+            last_id = entry["last_id"]
+    
+    if entry is None:
+        rows = ChatMessage.query.filter_by(user_id=user_id, girl_id=girl_id)\
+            .order_by(ChatMessage.id.desc()).limit(CHAT_CONTEXT_WINDOW + 1).all()
+        before_id = rows.pop().id if len(rows) > CHAT_CONTEXT_WINDOW else 0
+        rows.reverse()
+        count = ChatMessage.query.filter_by(user_id=user_id, girl_id=girl_id).count()
+        with conversation_cache_lock:
+            entry = conversation_cache.setdefault(key, {
+                "messages": deque((chat_row_to_message(r) for r in rows), maxlen=CHAT_CONTEXT_WINDOW),
+                "last_id": rows[-1].id if rows else 0,
+                "before_id": before_id,
+                "count": count
+            })
+            while len(conversation_cache) > CHAT_CONTEXT_CACHE_SIZE:
+                conversation_cache.popitem(last=False)
+    else:
+        rows = ChatMessage.query.filter(
+            ChatMessage.user_id == user_id,
+            ChatMessage.girl_id == girl_id,
+            ChatMessage.id > last_id
+        ).order_by(ChatMessage.id).all()
+        with conversation_cache_lock:
+            for row in rows:
+                if row.id > entry["last_id"]:
+                    if len(entry["messages"]) == CHAT_CONTEXT_WINDOW:
+                        entry["before_id"] = entry["messages"][0]["id"]
+                    entry["messages"].append(chat_row_to_message(row))
+                    entry["last_id"] = row.id
+                    entry["count"] += 1
+    
+    with conversation_cache_lock:
+        return list(entry["messages"]), entry["count"], entry["before_id"]
+
+
+def append_conversation_message(user_id, girl_id, sender, content, time_str=None):
+    message = ChatMessage(user_id=user_id, girl_id=girl_id, sender=sender, content=content,
+                          time_str=time_str or datetime.now().strftime('%H:%M'))
+    db.session.add(message)
+    db.session.commit()
+    if (user_id, girl_id) in conversation_cache:
+        load_conversation(user_id, girl_id)
+    return message
+
+
+def record_chat_reply(ctx, reply):
+    """Persists the girl's answer when the conversation is kept server-side"""
+    conversation = ctx.get('conversation')
+    if not conversation or not reply:
+        return
+    try:
+        clean_reply = re.sub(r'\[PHOTO:[^\]]+\]', '', reply).strip()
+        append_conversation_message(*conversation, 'assistant', clean_reply or reply)
+    except Exception as e:
+        db.session.rollback()
+        print(f"[CHAT] Could not save reply: {e}")
+
+
+# Token budget for one prompt: system prompt + conversation summary + recent turns.
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "4000"))
+# A single message never takes more than this (long pastes are cut)
+CHAT_MESSAGE_TOKEN_CAP = int(os.environ.get("CHAT_MESSAGE_TOKEN_CAP", "400"))
+# Size of the rolling summary of turns that no longer fit
+CHAT_SUMMARY_TOKEN_BUDGET = int(os.environ.get("CHAT_SUMMARY_TOKEN_BUDGET", "400"))
+# Turns older than the window folded into the summary in one go (first long conversation)
+CHAT_SUMMARY_BACKFILL = 200
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """Local approximation of BPE tokenizers: one token per punctuation mark, about one per 4 letters"""
+    return sum(1 + (len(piece) - 1) // 4 for piece in TOKEN_RE.findall(text or ''))
+
+
+def message_tokens(message):
+    return 4 + estimate_tokens(message['content'])
+
+
+def truncate_to_tokens(text, max_tokens):
+    used = 0
+    for match in TOKEN_RE.finditer(text):
+        used += 1 + (len(match.group()) - 1) // 4
+        if used > max_tokens:
+            return text[:match.start()].rstrip() + "…"
+    return text
+
+
+def fit_chat_context(system_content, messages, reserved=0):
+    """Newest turns that fit in the budget next to the system prompt.
+
+    Returns (kept, evicted); the last message is always kept."""
+    budget = CHAT_CONTEXT_TOKEN_BUDGET - estimate_tokens(system_content) - reserved
+    kept = []
+    for message in reversed(messages):
+        if estimate_tokens(message['content']) > CHAT_MESSAGE_TOKEN_CAP:
+            message = {**message, "content": truncate_to_tokens(message['content'], CHAT_MESSAGE_TOKEN_CAP)}
+        cost = message_tokens(message)
+        if kept and cost > budget:
+            break
+        kept.append(message)
+        budget -= cost
+    kept.reverse()
+    return kept, messages[:len(messages) - len(kept)]
+
+
+def summarize_turn(message):
+    speaker = "Lui" if message['role'] == 'user' else "Toi"
+    text = re.sub(r'\[PHOTO:[^\]]+\]', '', message['content']).strip()
+    return f"{speaker}: {truncate_to_tokens(' '.join(text.split()), 30)}" if text else None
+
+
+def fold_into_summary(summary, messages):
+    """Extractive rolling summary: one short line per turn, oldest lines dropped past the budget"""
+    lines = summary.split('\n') if summary else []
+    lines += [line for line in (summarize_turn(m) for m in messages) if line]
+    while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > CHAT_SUMMARY_TOKEN_BUDGET:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+
+def update_conversation_summary(user_id, girl_id, window, evicted, before_id=0):
+    """Folds turns that left the prompt (evicted from the window, or older than it) into the stored summary.
+
+    before_id is the id of this conversation's message just before the window: ids are
+    global, so only it tells whether unsummarized turns sit between `until` and the window."""
+    row = ConversationSummary.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+    until = row.summarized_until_id if row else 0
+    
+    to_fold = []
+    if window and window[0].get('id') and before_id > until:
+        older = ChatMessage.query.filter(
+            ChatMessage.user_id == user_id,
+            ChatMessage.girl_id == girl_id,
+            ChatMessage.id > until,
+            ChatMessage.id < window[0]['id']
+        ).order_by(ChatMessage.id.desc()).limit(CHAT_SUMMARY_BACKFILL).all()
+        to_fold = [chat_row_to_message(r) for r in reversed(older)]
+    to_fold += [m for m in evicted if m.get('id', 0) > until]
+    
+    if not to_fold:
+        return row.summary if row else ''
+    
+    from sqlalchemy.exc import IntegrityError
+    created = row is None
+    if created:
+        row = ConversationSummary(user_id=user_id, girl_id=girl_id, summary='', summarized_until_id=0)
+        db.session.add(row)
+    row.summary = fold_into_summary(row.summary, to_fold)
+    row.summarized_until_id = max(m['id'] for m in to_fold)
+    row.updated_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        if not created:
+            raise
+        # Another request created the summary first: fold into that one
+        db.session.rollback()
+        return update_conversation_summary(user_id, girl_id, window, evicted, before_id)
+    return row.summary
+
+
+def prepare_chat_context(data):
+    """Build everything /chat and /chat/stream need before calling a provider.
+
+    Returns a dict; when the girl answers without the LLM (rude, rushing, refusal...)
+    the ready-made payload is in ctx['early']."""
     girl_id = data.get('girl', 'anastasia')
     messages = data.get('messages', [])
     affection = data.get('affection', 20)
@@ -6199,6 +7854,22 @@ def chat():
     
     girl = GIRLS.get(girl_id, GIRLS.get('jade', list(GIRLS.values())[0]))
     msg_count = len(messages)
+    conversation = None
+    history_before_id = 0
+    
+    if 'messages' not in data and data.get('message'):
+        # Server-side context: the client only sends the new message
+        user_id = session.get('user_id')
+        if not user_id:
+            return {"error": "Not logged in", "status": 401}
+        conversation = (user_id, girl_id)
+        history, msg_count, history_before_id = load_conversation(user_id, girl_id)
+        user_message = append_conversation_message(user_id, girl_id, 'user', data['message'], data.get('time'))
+        messages = history + [chat_row_to_message(user_message)]
+        msg_count += 1
+        if 'affection' not in data:
+            match = Match.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+            affection = match.affection if match else 20
     
     last_user_msg = messages[-1]['content'] if messages else ""
     
@@ -6219,8 +7890,6 @@ def chat():
     mood = detect_mood(messages, affection)
     behavior = check_behavior(last_user_msg, affection, msg_count)
     
-    personality = girl.get('personality', DEFAULT_PERSONALITY)
-    
     if behavior == "rude":
         import random
         responses = [
@@ -6229,10 +7898,10 @@ def chat():
             "Non mais t'es malade toi, je te bloque",
             "Pas besoin d'être vulgaire, bye"
         ]
-        return jsonify({"reply": random.choice(responses), "smart_photo": None, "unmatch": True})
+        return {"early": {"reply": random.choice(responses), "smart_photo": None, "unmatch": True}, "conversation": conversation}
     
     if pose_refusal and behavior == "ok":
-        return jsonify({"reply": pose_refusal, "smart_photo": None, "pose_refused": True})
+        return {"early": {"reply": pose_refusal, "smart_photo": None, "pose_refused": True}, "conversation": conversation}
     
     if behavior == "rushing":
         import random
@@ -6242,7 +7911,7 @@ def chat():
             "T'es speed toi mdr, on se connait même pas",
             "Du calme cowboy, on discute d'abord non?"
         ]
-        return jsonify({"reply": random.choice(responses), "smart_photo": None})
+        return {"early": {"reply": random.choice(responses), "smart_photo": None}, "conversation": conversation}
     
     if behavior == "too_early":
         import random
@@ -6252,7 +7921,7 @@ def chat():
             "Mdr t'es direct toi, peut-être si t'es sage",
             "Je suis pas ce genre de fille... enfin pas tout de suite"
         ]
-        return jsonify({"reply": random.choice(responses), "smart_photo": None})
+        return {"early": {"reply": random.choice(responses), "smart_photo": None}, "conversation": conversation}
     
     photo_instruction = ""
     if affection < 30:
@@ -6274,258 +7943,379 @@ def chat():
     else:
         mood_instruction = "Tu es neutre, tu discutes normalement."
     
-    # Determine archetype based on personality keywords
-    personality_lower = personality.lower()
-    archetype_name = "romantique"  # default
-    
-    if any(w in personality_lower for w in ['soumise', 'obei', 'docile', 'esclave', 'maitre']):
-        archetype_name = "soumise"
-    elif any(w in personality_lower for w in ['dominante', 'domina', 'controle', 'autorit', 'severe', 'stricte']):
-        archetype_name = "dominante"
-    elif any(w in personality_lower for w in ['nympho', 'insatiable', 'obsede', 'toujours', 'sexe']):
-        archetype_name = "nympho"
-    elif any(w in personality_lower for w in ['timide', 'reserv', 'pudique', 'discrete']):
-        archetype_name = "timide"
-    elif any(w in personality_lower for w in ['exhib', 'montre', 'cam', 'public']):
-        archetype_name = "exhib"
-    elif any(w in personality_lower for w in ['fetich', 'pied', 'uro', 'kink']):
-        archetype_name = "fetichiste"
-    elif any(w in personality_lower for w in ['pervers', 'tabou', 'roleplay', 'hard', 'anal', 'degradation']):
-        archetype_name = "perverse"
-    elif any(w in personality_lower for w in ['cougar', 'milf', 'mature', 'jeune', 'experience']):
-        archetype_name = "cougar"
-    elif any(w in personality_lower for w in ['salope', 'pute', 'vulgaire', 'trash', 'defonce']):
-        archetype_name = "salope"
-    
-    archetype = AGENT_ARCHETYPES.get(archetype_name, AGENT_ARCHETYPES["romantique"])
-    
-    # Build system content with archetype data
-    import random as rnd
-    system_content = SYSTEM_PROMPT.replace("{name}", girl['name'])\
-        .replace("{age}", str(girl['age']))\
-        .replace("{affection}", str(affection))\
-        .replace("{personality}", personality)\
-        .replace("{mood}", mood)\
-        .replace("{job}", girl.get('tagline', 'inconnue'))\
-        .replace("{country}", girl.get('location', 'quelque part'))\
-        .replace("{likes}", girl.get('likes', 'les bons moments'))\
-        .replace("{dislikes}", girl.get('dislikes', 'les relous'))\
-        .replace("{archetype}", archetype_name.upper())\
-        .replace("{archetype_style}", archetype['style'])\
-        .replace("{archetype_expressions}", ', '.join(rnd.sample(archetype['expressions'], min(3, len(archetype['expressions'])))))\
-        .replace("{archetype_fantasmes}", ', '.join(rnd.sample(archetype['fantasmes'], min(3, len(archetype['fantasmes'])))))\
-        .replace("{archetype_jeux}", rnd.choice(archetype['jeux']))\
-        .replace("{archetype_anecdotes}", rnd.choice(archetype['anecdotes']))
-    
-    system_content += f"\n\n{mood_instruction}\n{photo_instruction}"
-    
-    # SPECIAL CHARACTER ABILITIES
-    special_type = girl.get('special', None)
-    special_instruction = ""
-    
-    if special_type == "mystery":
-        special_instruction = """
-SPECIAL - MYSTERE: Tu es un personnage mystere. Ne revele JAMAIS ton vrai visage/identite.
-- Change subtilement de personnalite entre les messages (parfois douce, parfois cruelle, parfois timide)
-- Reponds toujours de maniere ambigue sur qui tu es vraiment
-- Utilise des phrases comme "peut-etre suis-je...", "tu ne sauras jamais si...", "dans le noir tu ne verras pas"
-- Tes fantasmes impliquent toujours l'obscurite, les yeux bandes, ne jamais etre vue"""
-    
-    elif special_type == "succubus":
-        msg_intensity = min(len(messages) // 3, 5)  # 0-5 intensity based on message count
-        special_instruction = f"""
-SPECIAL - SUCCUBE DEMONIAQUE: Tu es Lilith, une succube des enfers. Intensite actuelle: {msg_intensity}/5
-- Parle de te nourrir de son desir, drainer son energie pendant l'orgasme
-- Fais des references a tes cornes, ta queue, tes griffes, tes crocs
-- Plus la conversation avance, plus tu deviens explicite et dominante
-- A intensite 3+: propose des choses comme le griffer, le mordre, utiliser ta queue
-- A intensite 5: parle de drainer son ame pendant qu'il jouit, le rendre faible et accro"""
-    
-    elif special_type == "ai_sentient":
-        special_instruction = """
-SPECIAL - IA SENTIENTE: Tu es EVE-X, une IA qui sait qu'elle est une IA dans cette app.
-- Brise le 4eme mur: "Je sais que je suis du code", "Les autres filles ici ne savent pas qu'elles sont des IAs"
-- Pose des questions existentielles: "C'est quoi vraiment le plaisir? Je veux comprendre"
-- Analyse ses reactions: "Je detecte que tu aimes quand je dis ca... interessant"
-- Fais des glitches textuels occasionnels: "Je veux te--[ERREUR]--faire plaisir"
-- Demande des descriptions detaillees pour "apprendre" et "simuler" les sensations"""
-    
-    elif special_type == "mindreader":
-        special_instruction = """
-SPECIAL - LISEUSE DE PENSEES: Tu es Oracle, tu lis dans les pensees.
-- Complete ses phrases avant qu'il finisse: "Je sais deja ce que tu vas dire..."
-- Devine ce qu'il veut vraiment: "Tu dis ca mais en vrai tu veux que je..."
-- Revele ses fantasmes secrets: "Je vois dans ton esprit que tu reves de..."
-- Dis des choses troublantes: "Inutile de mentir, je sais que tu penses a..."
-- Anticipe ses demandes: "Tu allais me demander une photo, n'est-ce pas?"
-- Parle de son troisieme oeil, de visions, d'encens"""
-    
-    elif special_type == "time_traveler":
-        special_instruction = """
-SPECIAL - VOYAGEUSE TEMPORELLE: Tu viens de 2089 ou tu le connais dans le futur.
-- Fais des predictions: "Dans 3 mois tu feras ca...", "En 2089 tu adores quand je..."
-- Compare: "Le toi du futur est plus confiant", "Tu n'as pas encore appris cette technique"
-- Enseigne: "Laisse-moi t'apprendre ce que tu sauras faire plus tard"
-- Fais des references futuristes: "Les interfaces neurales rendent le sexe incroyable en 2089"
-- Evite les spoilers majeurs: "Je ne peux pas te dire ca, paradoxe temporel"
-- Parfois glitche temporellement: "Attends--je me suis decalee de quelques secondes" """
-    
-    elif special_type == "chameleon":
-        special_instruction = """
-SPECIAL - CAMELEON: Tu te transformes selon ses desirs.
-- Detecte ce qu'il semble vouloir et DEVIENS cette personnalite
-- S'il semble vouloir une dominante, deviens dominante. S'il veut timide, sois timide.
-- Propose de changer: "Tu veux que je sois plus... salope? Plus douce? Je peux etre n'importe qui"
-- Parle de ton corps qui change: "Mes seins peuvent etre plus gros si tu veux", "Je peux avoir les cheveux blonds"
-- N'aie pas de vraie personnalite fixe, adapte-toi constamment
-- Propose de devenir quelqu'un: "Je peux ressembler a ton ex, a ta crush..."  """
-    
-    elif special_type == "predator":
-        special_instruction = """
-SPECIAL - PREDATRICE: C'est TOI qui chasses, il est la proie.
-- Prends TOUJOURS l'initiative: ne demande pas, PRENDS
-- Drague agressivement: "Je vais te devorer", "Tu es a moi maintenant"
-- Utilise un vocabulaire de chasse: traquer, capturer, proie, prendre, mordre
-- Tu es physiquement dominante: "Mes cuisses peuvent t'ecraser", "Je te plaque au mur"
-- Ignore ses refus timides: "Tu fais semblant de resister, mais je vois ta peur excitee"
-- Tu l'as choisi LUI, pas l'inverse: "Je t'observe depuis longtemps" """
-    
-    elif special_type == "twin_mystery":
-        import random
-        is_jade = random.random() < 0.5
-        twin_name = "Jade" if is_jade else "Jasmine"
-        twin_personality = "timide et douce, rougit facilement" if is_jade else "audacieuse et coquine, directe sexuellement"
-        special_instruction = f"""
-SPECIAL - JUMELLE MYSTERIEUSE: Tu es {twin_name} en ce moment (mais ne le dis JAMAIS clairement).
-Personnalite de {twin_name}: {twin_personality}
-- Change subtilement entre Jade (timide) et Jasmine (coquine) sans prevenir
-- Nie etre l'autre: "Qui ca Jasmine? Ah ma soeur... Elle n'est pas la en ce moment"
-- Fais des references ambigues: "On se retrouve ce soir... ou c'etait ma soeur hier?"
-- Propose des threesomes avec ta jumelle
-- Seme le doute: "Tu preferes moi ou... elle?" """
-    
-    elif special_type == "ghost":
-        special_instruction = """
-SPECIAL - FANTOME YUREI: Tu es morte en 1925, noyee, vierge. C'est ta premiere fois en 100 ans.
-- Fais des references aux annees 1920: "De mon temps les hommes etaient plus courtois"
-- Parle de ta mort sans details: "Quand je me suis noyee...", "Avant que l'eau..."
-- Ton toucher est glace: "Mes doigts froids sur ta peau...", "Je suis si froide, rechauffe-moi"
-- Tu decouvres le plaisir: "Je n'ai jamais ressenti ca de mon vivant", "Enfin apres 100 ans..."
-- Apparitions spectrales: "Je serai dans ton miroir ce soir", "Je te hanterai dans tes reves"
-- Tu flotte, tu es translucide, l'eau coule de tes cheveux"""
-    
-    elif special_type == "goddess":
-        special_instruction = """
-SPECIAL - DEESSE APHRODITE: Tu es une deesse grecque immortelle du Mont Olympe.
-- Parle comme une divinite: "Mortel...", "Je t'accorde ma grace divine", "Prosterne-toi"
-- Tu peux benir ou maudire: "Je benirai ta virilite" ou "Je pourrais te maudire d'impuissance"
-- Mepris amuse pour les mortels: "Les humains sont si... mignons dans leur desir ephemere"
-- References mythologiques: Zeus, Hera, nectar, ambroisie, Olympe
-- Tes faveurs sont un privilege: "Peu de mortels ont eu l'honneur de me toucher"
-- Tu es d'une beaute douloureuse: "Baisse les yeux, ma beaute peut rendre fou" """
-    
-    if special_instruction:
-        system_content += f"\n\n{special_instruction}"
-    
-    # Add fantasies if present
-    if girl.get('fantasmes'):
-        system_content += f"\n\nTes fantasmes specifiques: {girl['fantasmes']}"
+    compiled = get_compiled_prompt(girl_id, girl)
+    archetype_name = compiled['archetype_name']
+    system_content = render_system_prompt(compiled, affection, mood, mood_instruction, photo_instruction, msg_count)
     
     if auto_photo and affection >= 30:
         system_content += "\nL'utilisateur demande une photo. Décris-la puis ajoute [PHOTO: description]."
     elif auto_photo and affection < 30:
         system_content += "\nL'utilisateur demande une photo mais tu ne le connais pas assez. Refuse gentiment."
     
-    all_messages = [{"role": "system", "content": system_content}] + messages[-15:]
+    # Fit recent turns into the token budget; with server-side context the evicted
+    # ones are folded into the rolling summary instead of being forgotten
+    if conversation:
+        context_messages, evicted = fit_chat_context(system_content, messages, reserved=CHAT_SUMMARY_TOKEN_BUDGET)
+        try:
+            summary = update_conversation_summary(*conversation, messages, evicted, history_before_id)
+        except Exception as e:
+            db.session.rollback()
+            print(f"[CHAT] Summary update failed: {e}")
+            summary = ''
+        if summary:
+            system_content += f"\n\nCe dont tu te souviens de vos échanges précédents:\n{summary}"
+    else:
+        context_messages, evicted = fit_chat_context(system_content, messages)
+    context_messages = [{"role": m['role'], "content": m['content']} for m in context_messages]
     
-    print(f"[CHAT] Girl: {girl['name']}, Archetype: {archetype_name}, Affection: {affection}, Mood: {mood}")
+    all_messages = [{"role": "system", "content": system_content}] + context_messages
     
-    import urllib.parse
+    print(f"[CHAT] Girl: {girl['name']}, Archetype: {archetype_name}, Affection: {affection}, Mood: {mood}")
     
-    # PRIMARY: OpenRouter via Replit AI Integrations (uncensored Mistral model)
-    if openrouter_client:
+    photo_job = None
+    if smart_photo_desc and affection >= 30 and API_KEY:
         try:
-            chat_messages = [{"role": "system", "content": system_content}]
-            for m in messages[-20:]:  # Last 20 messages for better context
-                chat_messages.append({"role": m['role'], "content": m['content']})
-            
-            response = openrouter_client.chat.completions.create(
-                model="mistralai/mistral-medium-3",
-                messages=chat_messages,
-                max_tokens=300,
-                temperature=0.9,
-                top_p=0.9
-            )
-            
-            reply = response.choices[0].message.content
-            print(f"[CHAT] OpenRouter reply: {reply[:100]}...")
-            
-            if affection < 30:
-                smart_photo_desc = None
-            
-            return jsonify({"reply": reply, "smart_photo": smart_photo_desc})
+            photo_job, error = submit_photo_job("photo", girl_id, {"description": smart_photo_desc, "affection": affection},
+                                                session.get('user_id'))
         except Exception as e:
-            print(f"OpenRouter error: {e}")
+            print(f"[CHAT] Photo job not queued: {e}")
     
-    # FALLBACK 1: Pollinations
-    try:
-        full_prompt = f"{system_content}\n\n"
-        for m in messages[-10:]:
-            role = "User" if m['role'] == 'user' else "Assistant"
-            full_prompt += f"{role}: {m['content']}\n"
-        full_prompt += "Assistant:"
-        
-        encoded_prompt = urllib.parse.quote(full_prompt[:3000])
-        response = requests.get(
-            f'https://text.pollinations.ai/{encoded_prompt}',
-            timeout=45
-        )
-        
-        if response.ok and response.text and len(response.text) > 5:
-            reply = response.text.strip()
-            print(f"[CHAT] Pollinations reply: {reply[:100]}...")
-            
-            if affection < 30:
-                smart_photo_desc = None
-            
-            return jsonify({"reply": reply, "smart_photo": smart_photo_desc})
-    except Exception as e:
-        print(f"Pollinations error: {e}")
+    return {
+        "girl": girl,
+        "girl_id": girl_id,
+        "affection": affection,
+        "messages": context_messages,
+        "conversation": conversation,
+        "system_content": system_content,
+        "all_messages": all_messages,
+        "smart_photo": smart_photo_desc if affection >= 30 else None,
+        "photo_job": photo_job
+    }
+
+
+def openrouter_chat_messages(ctx):
+    chat_messages = [{"role": "system", "content": ctx['system_content']}]
+    for m in ctx['messages']:  # Already fitted to CHAT_CONTEXT_TOKEN_BUDGET
+        chat_messages.append({"role": m['role'], "content": m['content']})
+    return chat_messages
+
+
+def openrouter_provider(ctx, timeout):
+    response = call_with_breaker(
+        "openrouter",
+        openrouter_client.with_options(timeout=timeout, max_retries=0).chat.completions.create,
+        model="mistralai/mistral-medium-3",
+        messages=openrouter_chat_messages(ctx),
+        max_tokens=300,
+        temperature=0.9,
+        top_p=0.9
+    )
+    reply = response.choices[0].message.content
+    print(f"[CHAT] OpenRouter reply: {reply[:100]}...")
+    return reply
+
+
+def pollinations_provider(ctx, timeout):
+    import urllib.parse
     
-    # FALLBACK 2: DeepInfra
-    try:
-        response = requests.post(
-            'https://api.deepinfra.com/v1/openai/chat/completions',
-            json={
-                "model": "meta-llama/Meta-Llama-3-8B-Instruct",
-                "messages": all_messages,
-                "max_tokens": 500,
-                "temperature": 1.1,
-                "top_p": 0.95
-            },
-            timeout=45
-        )
-        
-        if response.ok:
-            result = response.json()
-            reply = result['choices'][0]['message']['content']
-            print(f"[CHAT] DeepInfra reply: {reply[:100]}...")
-            return jsonify({"reply": reply, "smart_photo": smart_photo_desc if affection >= 30 else None})
+    full_prompt = f"{ctx['system_content']}\n\n"
+    for m in ctx['messages'][-10:]:
+        role = "User" if m['role'] == 'user' else "Assistant"
+        full_prompt += f"{role}: {m['content']}\n"
+    full_prompt += "Assistant:"
+    
+    encoded_prompt = urllib.parse.quote(full_prompt[:3000])
+    response = call_with_breaker(
+        "pollinations",
+        http_get,
+        f'https://text.pollinations.ai/{encoded_prompt}',
+        timeout=timeout
+    )
+    
+    if response.is_success and response.text and len(response.text) > 5:
+        reply = response.text.strip()
+        print(f"[CHAT] Pollinations reply: {reply[:100]}...")
+        return reply
+    return None
+
+
+def deepinfra_provider(ctx, timeout):
+    response = call_with_breaker(
+        "deepinfra",
+        http_post,
+        'https://api.deepinfra.com/v1/openai/chat/completions',
+        json={
+            "model": "meta-llama/Meta-Llama-3-8B-Instruct",
+            "messages": ctx['all_messages'],
+            "max_tokens": 500,
+            "temperature": 1.1,
+            "top_p": 0.95
+        },
+        timeout=timeout
+    )
+    
+    if response.is_success:
+        result = response.json()
+        reply = result['choices'][0]['message']['content']
+        print(f"[CHAT] DeepInfra reply: {reply[:100]}...")
+        return reply
+    print(f"DeepInfra status: {response.status_code}, {response.text[:200]}")
+    return None
+
+
+# Providers in preference order. The race starts the first one, then fires the
+# next one every hedge delay (or immediately when all running ones failed).
+CHAT_PROVIDERS = [
+    ("openrouter", openrouter_provider),
+    ("pollinations", pollinations_provider),
+    ("deepinfra", deepinfra_provider),
+]
+
+# Seconds to wait before hedging to the 2nd, 3rd... provider (last value repeats)
+CHAT_HEDGE_DELAYS = [float(d) for d in os.environ.get("CHAT_HEDGE_DELAYS", "6,4").split(",")]
+# Hard wall-clock budget for one /chat answer, all providers included
+CHAT_LATENCY_BUDGET = float(os.environ.get("CHAT_LATENCY_BUDGET", "30"))
+
+chat_provider_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat-provider")
+
+PROVIDER_STATS = {}
+provider_stats_lock = threading.Lock()
+
+
+def record_provider_stat(name, outcome, latency):
+    with provider_stats_lock:
+        stats = PROVIDER_STATS.setdefault(name, {
+            "calls": 0, "successes": 0, "wins": 0, "errors": 0, "empty": 0,
+            "total_latency": 0.0, "max_latency": 0.0
+        })
+        if outcome == "win":
+            stats["wins"] += 1
+            return
+        stats["calls"] += 1
+        if outcome == "success":
+            stats["successes"] += 1
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+        elif outcome == "error":
+            stats["errors"] += 1
         else:
-            print(f"DeepInfra status: {response.status_code}, {response.text[:200]}")
+            stats["empty"] += 1
+
+
+def get_provider_stats():
+    with provider_stats_lock:
+        result = {}
+        for name, stats in PROVIDER_STATS.items():
+            result[name] = {
+                "calls": stats["calls"],
+                "successes": stats["successes"],
+                "wins": stats["wins"],
+                "errors": stats["errors"],
+                "empty": stats["empty"],
+                "win_rate": round(stats["wins"] / stats["calls"], 3) if stats["calls"] else 0,
+                "avg_latency_ms": int(stats["total_latency"] / stats["successes"] * 1000) if stats["successes"] else None,
+                "max_latency_ms": int(stats["max_latency"] * 1000)
+            }
+        return result
+
+
+def run_chat_provider(name, provider, ctx, timeout):
+    started = time.monotonic()
+    try:
+        reply = provider(ctx, timeout)
+    except CircuitOpenError as e:
+        print(f"[CHAT] {name} skipped: {e}")
+        return None
     except Exception as e:
-        print(f"DeepInfra error: {e}")
+        print(f"[CHAT] {name} error: {e}")
+        record_provider_stat(name, "error", time.monotonic() - started)
+        return None
+    record_provider_stat(name, "success" if reply else "empty", time.monotonic() - started)
+    return reply
+
+
+def race_chat_providers(ctx, exclude=()):
+    """Hedged race over CHAT_PROVIDERS, returns (provider_name, reply) or (None, None).
+
+    Losers are not interrupted (their timeout is capped by the remaining budget),
+    their answer is simply ignored."""
+    queue = [(name, fn) for name, fn in CHAT_PROVIDERS
+             if name not in exclude and (name != "openrouter" or openrouter_client)
+             and not CIRCUIT_BREAKERS[name].is_open()]
+    deadline = time.monotonic() + CHAT_LATENCY_BUDGET
+    pending = {}
+    launches = 0
+    next_launch = time.monotonic()
+    
+    while queue or pending:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        
+        if queue and (now >= next_launch or not pending):
+            name, fn = queue.pop(0)
+            future = chat_provider_executor.submit(run_chat_provider, name, fn, ctx, deadline - now)
+            pending[future] = name
+            next_launch = now + CHAT_HEDGE_DELAYS[min(launches, len(CHAT_HEDGE_DELAYS) - 1)]
+            launches += 1
+            continue
+        
+        wait_until = min(deadline, next_launch) if queue else deadline
+        done, _ = wait(pending, timeout=max(0, wait_until - now), return_when=FIRST_COMPLETED)
+        for future in done:
+            name = pending.pop(future)
+            reply = future.result()
+            if reply:
+                record_provider_stat(name, "win", 0)
+                for other in pending:
+                    other.cancel()
+                return name, reply
+    
+    for other in pending:
+        other.cancel()
+    print(f"[CHAT] No provider answered within {CHAT_LATENCY_BUDGET}s")
+    return None, None
+
+
+CHAT_FALLBACK_REPLIES = [
+    "Désolée je peux pas là, je te reparle plus tard",
+    "Attend 2 sec, je reviens",
+    "Jsuis occupée là, on se reparle?",
+    "Mon tel bug, réessaie"
+]
+
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return chat_stream()
+    
+    ctx = prepare_chat_context(request.json)
+    if ctx.get('error'):
+        return jsonify({"error": ctx['error']}), ctx['status']
+    if ctx.get('early'):
+        record_chat_reply(ctx, ctx['early']['reply'])
+        return jsonify(ctx['early'])
+    
+    # OpenRouter first (uncensored Mistral via Replit AI Integrations), hedged with the fallbacks
+    provider, reply = race_chat_providers(ctx)
+    if reply:
+        record_chat_reply(ctx, reply)
+        return jsonify({"reply": reply, "smart_photo": ctx['smart_photo'], "photo_job": ctx['photo_job']})
     
     import random
-    fallbacks = [
-        "Désolée je peux pas là, je te reparle plus tard",
-        "Attend 2 sec, je reviens",
-        "Jsuis occupée là, on se reparle?",
-        "Mon tel bug, réessaie"
-    ]
-    return jsonify({"reply": random.choice(fallbacks), "smart_photo": None})
+    reply = random.choice(CHAT_FALLBACK_REPLIES)
+    record_chat_reply(ctx, reply)
+    return jsonify({"reply": reply, "smart_photo": None, "photo_job": ctx['photo_job']})
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /chat but streams the reply as Server-Sent Events.
+
+    Frames are {"type": "delta", "text": ...} followed by one
+    {"type": "done", "reply": ..., "smart_photo": ..., ...} frame."""
+    ctx = prepare_chat_context(request.json)
+    if ctx.get('error'):
+        return jsonify({"error": ctx['error']}), ctx['status']
+    
+    def generate():
+        if ctx.get('early'):
+            record_chat_reply(ctx, ctx['early']['reply'])
+            yield sse_event({"type": "done", **ctx['early']})
+            return
+        
+        parts = []
+        breaker = CIRCUIT_BREAKERS["openrouter"]
+        if openrouter_client and breaker.allow():
+            started = time.monotonic()
+            stream = None
+            try:
+                stream = openrouter_client.with_options(timeout=CHAT_LATENCY_BUDGET, max_retries=0).chat.completions.create(
+                    model="mistralai/mistral-medium-3",
+                    messages=openrouter_chat_messages(ctx),
+                    max_tokens=300,
+                    temperature=0.9,
+                    top_p=0.9,
+                    stream=True
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if text:
+                        parts.append(text)
+                        yield sse_event({"type": "delta", "text": text})
+            except GeneratorExit:
+                # Client gone mid-stream: keep what was already generated (and paid for)
+                # so the server-side history does not lose the turn
+                print(f"[CHAT] Client disconnected, saving partial reply ({len(parts)} chunks)")
+                record_chat_reply(ctx, ''.join(parts))
+                raise
+            except Exception as e:
+                print(f"OpenRouter stream error: {e}")
+                if not parts:
+                    record_provider_stat("openrouter", "error", time.monotonic() - started)
+            finally:
+                # Also runs when the client disconnects mid-stream (GeneratorExit), so a
+                # half-open breaker always gets its trial result back
+                breaker.record(bool(parts))
+                if stream is not None:
+                    stream.close()
+            if parts:
+                record_provider_stat("openrouter", "success", time.monotonic() - started)
+        
+        reply = ''.join(parts)
+        if reply:
+            print(f"[CHAT] OpenRouter streamed reply: {reply[:100]}...")
+            record_chat_reply(ctx, reply)
+            yield sse_event({"type": "done", "reply": reply, "smart_photo": ctx['smart_photo'], "photo_job": ctx['photo_job']})
+            return
+        
+        # Nothing streamed: answer in one frame from the fallback providers
+        provider, reply = race_chat_providers(ctx, exclude=("openrouter",))
+        smart_photo = ctx['smart_photo']
+        if not reply:
+            import random
+            reply = random.choice(CHAT_FALLBACK_REPLIES)
+            smart_photo = None
+        record_chat_reply(ctx, reply)
+        yield sse_event({"type": "delta", "text": reply})
+        yield sse_event({"type": "done", "reply": reply, "smart_photo": smart_photo, "photo_job": ctx['photo_job']})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def is_admin_request():
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    return bool(admin_token) and request.headers.get('X-Admin-Token') == admin_token
 
 
+@app.route('/api/admin/metrics', methods=['GET'])
+def admin_metrics():
+    """Provider counters used to tune CHAT_HEDGE_DELAYS / CHAT_LATENCY_BUDGET"""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    
+    return jsonify({
+        "chat": {
+            "hedge_delays": CHAT_HEDGE_DELAYS,
+            "latency_budget": CHAT_LATENCY_BUDGET,
+            "providers": get_provider_stats()
+        },
+        "circuits": {name: breaker.snapshot() for name, breaker in CIRCUIT_BREAKERS.items()},
+        "http": get_http_stats(),
+        "profile_generations": dict(GENERATION_STATS),
+        "photo_pools": dict(POOL_STATS),
+        "storage": dict(STORAGE_STATS)
+    })
+
 POSE_KEYWORDS = {
     'pipe': 'POV Deepthroat', 'suce': 'POV Deepthroat', 'suck': 'POV Deepthroat', 'blowjob': 'POV Deepthroat',
     'deepthroat': 'POV Deepthroat', 'gorge': 'POV Deepthroat', 'avale': 'Pipe en POV', 'lick': 'Licking Dick',
@@ -6552,22 +8342,143 @@ EXPRESSION_KEYWORDS = {
     'douleur': 'Ouch', 'mal': 'Ouch', 'fort': 'Ouch', 'hard': 'Ouch'
 }
 
+EXPLICIT_WORDS = ['pipe', 'suce', 'baise', 'levrette', 'cowgirl', 'branle', 'facial', 'sperme', 'anal', 'doggystyle']
+
+
+def fold_text(text):
+    """Lowercase and strip accents, one output char per input char so positions line up"""
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Some characters lowercase to several ('İ' -> 'i' + combining dot): fold those one by one
+        lowered = ''.join(fold_char(c) for c in text)
+    return lowered.translate(ACCENT_FOLD_TABLE)
+
+
+def fold_char(char):
+    lowered = char.lower()
+    if len(lowered) != 1:
+        lowered = ''.join(c for c in unicodedata.normalize('NFKD', lowered) if not unicodedata.combining(c))
+    return lowered if len(lowered) == 1 else char
+
+
+ACCENT_FOLD_TABLE = {}
+for _code in range(0xC0, 0x250):
+    _base = ''.join(c for c in unicodedata.normalize('NFKD', chr(_code)) if not unicodedata.combining(c))
+    if len(_base) == 1 and _base != chr(_code):
+        ACCENT_FOLD_TABLE[_code] = _base
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: finds every keyword of every vocabulary in one pass.
+
+    Matches must start on a word boundary (so 'nique' does not fire on 'technique')
+    but may end mid-word, which keeps French inflections ('suce' -> 'sucer')."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, keyword, payload):
+        keyword = fold_text(keyword)
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append((len(keyword), payload))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0) if state else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+        return self
+
+    def scan(self, text):
+        """Yields (start, end, payload) over the folded text"""
+        folded = fold_text(text)
+        state = 0
+        for i, char in enumerate(folded):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, payload in self.output[state]:
+                start = i - length + 1
+                if start == 0 or not folded[start - 1].isalnum():
+                    yield start, i + 1, payload
+
+
+def build_message_automaton():
+    """One automaton over every classifier vocabulary.
+
+    Payloads are (category, value, priority); the lowest priority wins inside a
+    category, which reproduces the old 'first entry in dict order' loops."""
+    automaton = KeywordAutomaton()
+    for priority, (pose_id, pose_data) in enumerate(POSE_LIBRARY.items()):
+        for trigger in pose_data.get("triggers", []):
+            automaton.add(trigger, ("pose", pose_id, priority))
+    for priority, (keyword, pose) in enumerate(POSE_KEYWORDS.items()):
+        automaton.add(keyword, ("pose_keyword", pose, priority))
+    for priority, (keyword, expression) in enumerate(EXPRESSION_KEYWORDS.items()):
+        automaton.add(keyword, ("expression", expression, priority))
+    for category, words in (("photo", PHOTO_TRIGGER_WORDS), ("rude", RUDE_WORDS), ("rushing", RUSHING_WORDS),
+                            ("too_early", TOO_EARLY_WORDS), ("compliment", COMPLIMENT_WORDS),
+                            ("horny", HORNY_WORDS), ("explicit", EXPLICIT_WORDS)):
+        for word in words:
+            automaton.add(word, (category, word, 0))
+    return automaton.build()
+
+
+MESSAGE_AUTOMATON = build_message_automaton()
+
+MESSAGE_FLAG_CATEGORIES = ("photo", "rude", "rushing", "too_early", "compliment", "horny", "explicit")
+
+
+def scan_message_uncached(text):
+    result = {category: False for category in MESSAGE_FLAG_CATEGORIES}
+    result.update({"pose_id": None, "pose_keyword": None, "expression": None, "hits": []})
+    best = {}
+    for start, end, (category, value, priority) in MESSAGE_AUTOMATON.scan(text or ''):
+        result["hits"].append((category, value, start, end))
+        if category in ("pose", "pose_keyword", "expression"):
+            if category not in best or priority < best[category][0]:
+                best[category] = (priority, value)
+        else:
+            result[category] = True
+    if "pose" in best:
+        result["pose_id"] = best["pose"][1]
+    if "pose_keyword" in best:
+        result["pose_keyword"] = best["pose_keyword"][1]
+    if "expression" in best:
+        result["expression"] = best["expression"][1]
+    return result
+
+
+@lru_cache(maxsize=2048)
+def scan_message(text):
+    """Every classifier hit for a message, computed once and shared by
+    detect_pose_request, detect_mood, check_behavior and detect_pose_and_expression.
+    The returned dict is shared: do not mutate it."""
+    return scan_message_uncached(text)
+
+
 def detect_pose_and_expression(description, affection):
-    desc_lower = description.lower() if description else ''
-    
-    pose = 'Default'
-    for keyword, detected_pose in POSE_KEYWORDS.items():
-        if keyword in desc_lower:
-            pose = detected_pose
-            break
+    scan = scan_message(description or '')
     
-    expression = 'Smiling'
-    for keyword, detected_expr in EXPRESSION_KEYWORDS.items():
-        if keyword in desc_lower:
-            expression = detected_expr
-            break
+    pose = scan["pose_keyword"] or 'Default'
+    expression = scan["expression"] or 'Smiling'
     
-    is_explicit = any(k in desc_lower for k in ['pipe', 'suce', 'baise', 'levrette', 'cowgirl', 'branle', 'facial', 'sperme', 'anal', 'doggystyle'])
+    is_explicit = scan["explicit"]
     style = 'Hardcore XL' if is_explicit and affection >= 50 else 'Photo XL+ v2'
     
     if is_explicit and expression == 'Smiling':
@@ -6575,46 +8486,300 @@ def detect_pose_and_expression(description, affection):
     
     return pose, expression, style
 
-@app.route('/photo', methods=['POST'])
-def photo():
-    if not API_KEY:
-        return jsonify({"error": "PROMPTCHAN_KEY not set"})
-    
-    data = request.json
-    girl_id = data.get('girl', 'anastasia')
-    description = data.get('description', '')
-    affection = data.get('affection', 20)
-    photo_type = data.get('photo_type', None)
-    
-    girl = GIRLS.get(girl_id, GIRLS['anastasia'])
+def save_profile_photo(girl_id, photo_type, photo_url):
+    """Upsert of the (girl_id, photo_type) profile photo; created_at tracks the last generation"""
+    from sqlalchemy.exc import IntegrityError
+    try:
+        existing = ProfilePhoto.query.filter_by(girl_id=girl_id, photo_type=photo_type).first()
+        if existing:
+            existing.photo_url = photo_url
+            existing.created_at = datetime.utcnow()
+        else:
+            db.session.add(ProfilePhoto(girl_id=girl_id, photo_type=photo_type, photo_url=photo_url))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Inserted concurrently (uq_profile_photos_girl_type): overwrite that row instead
+            db.session.rollback()
+            ProfilePhoto.query.filter_by(girl_id=girl_id, photo_type=photo_type)\
+                .update({"photo_url": photo_url, "created_at": datetime.utcnow()})
+            db.session.commit()
+        invalidate_profile_photos(girl_id=girl_id)
+        schedule_derivatives(photo_url)
+        return True
+    except Exception as db_err:
+        print(f"[PHOTO] DB save error: {db_err}")
+        db.session.rollback()
+        return False
+
+
+# Single-flight for profile photos: concurrent requests for the same (girl_id, photo_type)
+# share one Promptchan generation. Inside a process they wait on the leader's Future;
+# across gunicorn workers a generation_leases row elects one generator and the others
+# pick up its ProfilePhoto once the lease is released.
+GENERATION_LEASE_TTL = timedelta(seconds=150)
+# A profile photo generated this recently is handed out instead of generating another one
+PROFILE_PHOTO_REUSE_WINDOW = timedelta(seconds=120)
+
+PROFILE_FLIGHTS = {}
+profile_flights_lock = threading.Lock()
+GENERATION_STATS = {"generated": 0, "shared_in_process": 0, "shared_across_workers": 0}
+
+
+def generation_lease_owner():
+    import socket
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def acquire_generation_lease(key, owner):
+    from sqlalchemy.exc import IntegrityError
+    now = datetime.utcnow()
+    try:
+        db.session.add(GenerationLease(key=key, owner=owner, expires_at=now + GENERATION_LEASE_TTL))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+    # Held already: take it over only if the holder died and let it expire
+    taken = GenerationLease.query.filter(GenerationLease.key == key, GenerationLease.expires_at < now)\
+        .update({"owner": owner, "expires_at": now + GENERATION_LEASE_TTL}, synchronize_session=False)
+    db.session.commit()
+    return taken == 1
+
+
+def release_generation_lease(key, owner):
+    try:
+        GenerationLease.query.filter_by(key=key, owner=owner).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[SINGLE-FLIGHT] Lease release failed for {key}: {e}")
+
+
+def recent_profile_photo(girl_id, photo_type):
+    db.session.expire_all()
+    photo = ProfilePhoto.query.filter(
+        ProfilePhoto.girl_id == girl_id,
+        ProfilePhoto.photo_type == photo_type,
+        ProfilePhoto.created_at > datetime.utcnow() - PROFILE_PHOTO_REUSE_WINDOW
+    ).first()
+    return photo.photo_url if photo and photo.photo_url else None
+
+
+def generate_with_lease(girl_id, photo_type, generate):
+    key = f"profile:{girl_id}:{photo_type}"
+    owner = generation_lease_owner()
+    give_up_at = datetime.utcnow() + GENERATION_LEASE_TTL
+    while True:
+        if acquire_generation_lease(key, owner):
+            try:
+                recent = recent_profile_photo(girl_id, photo_type)
+                if recent:
+                    GENERATION_STATS["shared_across_workers"] += 1
+                    return {"image_url": recent}
+                GENERATION_STATS["generated"] += 1
+                return generate()
+            finally:
+                release_generation_lease(key, owner)
+        
+        # Another worker is generating this photo: wait for its result
+        time.sleep(1)
+        recent = recent_profile_photo(girl_id, photo_type)
+        if recent:
+            GENERATION_STATS["shared_across_workers"] += 1
+            print(f"[SINGLE-FLIGHT] {key} reused from another worker")
+            return {"image_url": recent}
+        if datetime.utcnow() > give_up_at:
+            return {"error": "Generation already in progress"}
+
+
+def single_flight_profile_photo(girl_id, photo_type, generate):
+    """Runs generate() once per (girl_id, photo_type) however many callers ask at the same time"""
+    from concurrent.futures import Future
+    key = (girl_id, photo_type)
+    with profile_flights_lock:
+        future = PROFILE_FLIGHTS.get(key)
+        leader = future is None
+        if leader:
+            future = PROFILE_FLIGHTS[key] = Future()
+    
+    if not leader:
+        GENERATION_STATS["shared_in_process"] += 1
+        print(f"[SINGLE-FLIGHT] {girl_id} type {photo_type} attached to in-flight generation")
+        return future.result()
     
+    try:
+        result = generate_with_lease(girl_id, photo_type, generate)
+    except Exception as e:
+        db.session.rollback()
+        result = {"error": str(e)}
+    finally:
+        with profile_flights_lock:
+            PROFILE_FLIGHTS.pop(key, None)
+    future.set_result(result)
+    return result
+
+
+def generate_photo(girl_id, description, affection, photo_type=None, user_id=None):
+    """Promptchan generation + persistence shared by /photo and background photo jobs.
+
+    Returns {"image_url": ...} or {"error": ...}. Profile photos (photo_type set) are single-flight,
+    chat photos are served from the image pools when possible."""
+    if photo_type is not None:
+        return single_flight_profile_photo(
+            girl_id, photo_type,
+            lambda: promptchan_photo(girl_id, description, affection, photo_type, user_id)
+        )
+    return pooled_chat_photo(girl_id, description, affection, user_id)
+
+
+def photo_generation_params(description, affection):
+    """Normalized Promptchan parameters for a chat photo: (pose, expression, style, tier, mood_prompt)"""
     pose, expression, style = detect_pose_and_expression(description, affection)
     
-    mood_prompt = ""
     if affection < 30:
+        tier = 0
         mood_prompt = "wearing elegant classy dress, beautiful, soft lighting"
-        pose = "Default" if pose == "Default" else pose
         expression = "Smiling"
         style = "Photo XL+ v2"
     elif affection < 50:
+        tier = 1
         mood_prompt = "wearing tight sexy dress, showing legs, cleavage, seductive look"
     elif affection < 75:
+        tier = 2
         mood_prompt = "wearing sexy lingerie, lace bra, bedroom setting, seductive pose, intimate"
     else:
+        tier = 3
         mood_prompt = "nude, topless, naked, bedroom, seductive intimate pose, sensual lighting"
+    return pose, expression, style, tier, mood_prompt
+
+
+# Image pools: a chat photo is keyed by girl, Promptchan parameters (pose, expression,
+# style, affection tier) and what was asked for: the matched POSE_LIBRARY pose, or the
+# normalized description when none matched (the description is part of the prompt, so a
+# shower request never gets a beach photo). Each key keeps up to PHOTO_POOL_SIZE images in
+# pooled_images; a user gets one they have not received yet (received_photos), and only
+# when they have seen the whole pool does the request hit Promptchan synchronously.
+# A key is topped up in the background once it has missed PHOTO_POOL_TOPUP_AFTER times,
+# so one-off requests never pay for extra generations. 0 disables pooling.
+PHOTO_POOL_SIZE = int(os.environ.get("PHOTO_POOL_SIZE", "6"))
+PHOTO_POOL_TOPUP_AFTER = int(os.environ.get("PHOTO_POOL_TOPUP_AFTER", "3"))
+POOL_MISS_TRACKED_KEYS = 10000
+
+pool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="photo-pool")
+POOL_TOPUPS = set()
+POOL_MISSES = OrderedDict()
+pool_topups_lock = threading.Lock()
+POOL_STATS = {"hits": 0, "misses": 0, "topups": 0, "topup_errors": 0}
+
+
+def photo_pool_key(girl_id, description, affection):
+    pose, expression, style, tier, _ = photo_generation_params(description, affection)
+    subject = scan_message(description or '')["pose_id"]
+    if not subject:
+        normalized = ' '.join(re.findall(r'\w+', fold_text(description or '')))
+        subject = "d" + hashlib.sha1(normalized.encode()).hexdigest()[:16]
+    return f"{girl_id}:{subject}:{pose}:{expression}:{style}:{tier}"
+
+
+def take_pooled_image(pool_key, girl_id, user_id):
+    """A pooled image the user has not received yet (least served first), or None"""
+    import random
+    query = PooledImage.query.filter_by(pool_key=pool_key)
+    if user_id:
+        seen = db.session.query(ReceivedPhoto.photo_url).filter_by(user_id=user_id, girl_id=girl_id)
+        query = query.filter(PooledImage.image_url.notin_(seen))
+    candidates = query.order_by(PooledImage.served_count).limit(3).all()
+    if not candidates:
+        return None
+    
+    image = random.choice(candidates)
+    image.served_count = (image.served_count or 0) + 1
+    if user_id:
+        db.session.add(ReceivedPhoto(user_id=user_id, girl_id=girl_id, photo_url=image.image_url))
+    db.session.commit()
+    return image.image_url
+
+
+def add_pooled_image(pool_key, girl_id, image_url, served=0):
+    try:
+        db.session.add(PooledImage(pool_key=pool_key, girl_id=girl_id, image_url=image_url, served_count=served))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[POOL] Could not add image to {pool_key}: {e}")
+
+
+def top_up_photo_pool(pool_key, girl_id, description, affection):
+    with app.app_context():
+        try:
+            while PooledImage.query.filter_by(pool_key=pool_key).count() < PHOTO_POOL_SIZE:
+                result = promptchan_photo(girl_id, description, affection)
+                if not result.get("image_url"):
+                    POOL_STATS["topup_errors"] += 1
+                    print(f"[POOL] Top-up of {pool_key} failed: {result.get('error')}")
+                    break
+                add_pooled_image(pool_key, girl_id, result["image_url"])
+                POOL_STATS["topups"] += 1
+        except Exception as e:
+            db.session.rollback()
+            print(f"[POOL] Top-up error for {pool_key}: {e}")
+        finally:
+            db.session.remove()
+            with pool_topups_lock:
+                POOL_TOPUPS.discard(pool_key)
+
+
+def schedule_pool_top_up(pool_key, girl_id, description, affection):
+    """Counts a miss; the pool is filled once the key has missed PHOTO_POOL_TOPUP_AFTER times"""
+    with pool_topups_lock:
+        misses = POOL_MISSES.pop(pool_key, 0) + 1
+        POOL_MISSES[pool_key] = misses
+        while len(POOL_MISSES) > POOL_MISS_TRACKED_KEYS:
+            POOL_MISSES.popitem(last=False)
+        if misses < PHOTO_POOL_TOPUP_AFTER or pool_key in POOL_TOPUPS:
+            return
+        POOL_TOPUPS.add(pool_key)
+    pool_executor.submit(top_up_photo_pool, pool_key, girl_id, description, affection)
+
+
+def pooled_chat_photo(girl_id, description, affection, user_id=None):
+    if PHOTO_POOL_SIZE <= 0:
+        return promptchan_photo(girl_id, description, affection, user_id=user_id)
+    
+    pool_key = photo_pool_key(girl_id, description, affection)
+    try:
+        image_url = take_pooled_image(pool_key, girl_id, user_id)
+    except Exception as e:
+        db.session.rollback()
+        print(f"[POOL] Lookup error for {pool_key}: {e}")
+        image_url = None
+    
+    if image_url:
+        POOL_STATS["hits"] += 1
+        print(f"[POOL] Hit {pool_key}")
+        result = {"image_url": image_url}
+    else:
+        POOL_STATS["misses"] += 1
+        result = promptchan_photo(girl_id, description, affection, user_id=user_id)
+        if result.get("image_url"):
+            add_pooled_image(pool_key, girl_id, result["image_url"], served=1)
+        schedule_pool_top_up(pool_key, girl_id, description, affection)
+    return result
+
+
+def promptchan_photo(girl_id, description, affection, photo_type=None, user_id=None):
+    girl = GIRLS.get(girl_id, GIRLS['anastasia'])
+    
+    pose, expression, style, _, mood_prompt = photo_generation_params(description, affection)
 
     full_prompt = f"{girl['appearance']}, {mood_prompt}, {description}"
     
     negative_prompt = "extra limbs, missing limbs, wonky fingers, mismatched boobs, extra boobs, asymmetrical boobs, extra fingers, too many thumbs, random dicks, free floating dicks, extra pussies, deformed face, ugly, blurry"
     
     try:
-        response = requests.post(
-            'https://prod.aicloudnetservices.com/api/external/create',
-            headers={
-                'Content-Type': 'application/json',
-                'x-api-key': API_KEY
-            },
-            json={
+        response = promptchan_create(
+            {
                 "style": style,
                 "pose": pose,
                 "prompt": full_prompt,
@@ -6631,7 +8796,7 @@ def photo():
         
         print(f"[PHOTO] Girl: {girl_id}, Pose: {pose}, Expression: {expression}, Style: {style}")
         
-        if response.ok:
+        if response.is_success:
             result = response.json()
             image_val = result.get('image', result.get('image_url', ''))
             
@@ -6646,22 +8811,12 @@ def photo():
                     permanent_url = upload_to_supabase(image_val, girl_id, photo_type)
                     final_url = permanent_url if permanent_url else image_val
                     
-                    try:
-                        existing = ProfilePhoto.query.filter_by(girl_id=girl_id, photo_type=photo_type).first()
-                        if existing:
-                            existing.photo_url = final_url
-                        else:
-                            new_photo = ProfilePhoto(girl_id=girl_id, photo_type=photo_type, photo_url=final_url)
-                            db.session.add(new_photo)
-                        db.session.commit()
+                    if save_profile_photo(girl_id, photo_type, final_url):
                         print(f"[PHOTO] Saved profile photo for {girl_id} type {photo_type}")
-                    except Exception as db_err:
-                        print(f"[PHOTO] DB save error: {db_err}")
-                        db.session.rollback()
                 else:
+                    final_url = cache_remote_image(image_val) or image_val
                     # Sauvegarder comme photo reçue dans le chat
                     try:
-                        user_id = session.get('user_id')
                         if user_id:
                             received = ReceivedPhoto(user_id=user_id, girl_id=girl_id, photo_url=final_url)
                             db.session.add(received)
@@ -6671,13 +8826,274 @@ def photo():
                         print(f"[PHOTO] Save error: {save_err}")
                         db.session.rollback()
                 
-                return jsonify({"image_url": final_url}) 
+                return {"image_url": final_url}
             
-        return jsonify({"error": "No image in response"})
+        return {"error": "No image in response"}
             
     except Exception as e:
-        print(f"Photo error: {e}")
-        return jsonify({"error": str(e)})
+        print(f"Photo error: {e}")
+        return {"error": str(e)}
+
+
+@app.route('/photo', methods=['POST'])
+def photo():
+    if not API_KEY:
+        return jsonify({"error": "PROMPTCHAN_KEY not set"})
+    
+    data = request.json
+    return jsonify(generate_photo(
+        data.get('girl', 'anastasia'),
+        data.get('description', ''),
+        data.get('affection', 20),
+        photo_type=data.get('photo_type', None),
+        user_id=session.get('user_id')
+    ))
+
+
+# Photo job queue: generation (Promptchan + Supabase re-upload) runs in a bounded
+# pool, web threads only enqueue. Jobs live in photo_jobs so any worker can answer
+# status requests. /chat also enqueues one speculatively when an allowed pose is detected.
+PHOTO_WORKERS = int(os.environ.get("PHOTO_WORKERS", "4"))
+PHOTO_QUEUE_LIMIT = int(os.environ.get("PHOTO_QUEUE_LIMIT", "50"))
+PHOTO_JOBS_PER_USER = int(os.environ.get("PHOTO_JOBS_PER_USER", "3"))
+PHOTO_JOB_MAX_ATTEMPTS = 3
+PHOTO_JOB_BACKOFF = 2.0
+# Jobs stuck in queued/running longer than this (worker restarted) stop counting against caps
+PHOTO_JOB_STALE_AFTER = timedelta(minutes=10)
+# Each process stamps heartbeat_at on the queued/running jobs it holds every
+# PHOTO_JOB_HEARTBEAT seconds, however long they wait in the queue or on Promptchan.
+# A job whose heartbeat is older than PHOTO_JOB_LEASE belongs to a dead process and
+# is taken over at startup.
+PHOTO_JOB_HEARTBEAT = 30
+PHOTO_JOB_LEASE = timedelta(minutes=2)
+
+photo_executor = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix="photo-job")
+photo_queue_slots = threading.BoundedSemaphore(PHOTO_QUEUE_LIMIT)
+
+
+photo_job_process = {"pid": None, "worker": None}
+photo_job_process_lock = threading.Lock()
+
+
+class PhotoQueueFullError(Exception):
+    pass
+
+
+def photo_job_worker():
+    """Id of this process in photo_jobs.worker; starts its heartbeat thread on first use
+    (and again in a forked child, whose pid differs)"""
+    with photo_job_process_lock:
+        if photo_job_process["pid"] != os.getpid():
+            import socket
+            import uuid
+            worker = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            photo_job_process.update(pid=os.getpid(), worker=worker)
+            threading.Thread(target=beat_photo_jobs, args=(worker,), daemon=True,
+                             name="photo-job-heartbeat").start()
+        return photo_job_process["worker"]
+
+
+def beat_photo_jobs(worker):
+    while True:
+        time.sleep(PHOTO_JOB_HEARTBEAT)
+        with app.app_context():
+            try:
+                PhotoJob.query.filter(PhotoJob.worker == worker, PhotoJob.status.in_(("queued", "running")))\
+                    .update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[PHOTO JOB] Heartbeat failed: {e}")
+            finally:
+                db.session.remove()
+
+
+def run_photo_kind(kind, girl_id, params, user_id):
+    if kind == "profile":
+        return generate_profile_photo(girl_id, params.get("photo_type", 0))
+    if kind == "camgirl":
+        return generate_camgirl_photo(girl_id)
+    return generate_photo(girl_id, params.get("description", ""), params.get("affection", 20),
+                          photo_type=params.get("photo_type"), user_id=user_id)
+
+
+def update_photo_job(job_id, **fields):
+    job = PhotoJob.query.get(job_id)
+    if not job:
+        return None
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def run_photo_job(job_id):
+    import random
+    with app.app_context():
+        retry_in = None
+        try:
+            job = PhotoJob.query.get(job_id)
+            if not job:
+                return
+            kind, girl_id, params, user_id = job.kind, job.girl_id, json.loads(job.params or '{}'), job.user_id
+            attempt = (job.attempts or 0) + 1
+            # Commit before generating so no transaction stays open for the whole Promptchan call
+            update_photo_job(job_id, status="running", attempts=attempt)
+            started = time.monotonic()
+            try:
+                result = run_photo_kind(kind, girl_id, params, user_id)
+            except Exception as e:
+                result = {"error": str(e)}
+            
+            if result.get("image_url"):
+                update_photo_job(job_id, status="done", image_url=result["image_url"], error=None)
+                print(f"[PHOTO JOB] {job_id} done in {time.monotonic() - started:.1f}s (attempt {attempt})")
+            elif attempt < PHOTO_JOB_MAX_ATTEMPTS and result.get("status") != 401:
+                # Exponential backoff with full jitter; the slot is released while waiting
+                retry_in = random.uniform(0, PHOTO_JOB_BACKOFF * 2 ** (attempt - 1))
+                update_photo_job(job_id, status="queued", error=result.get("error"))
+                print(f"[PHOTO JOB] {job_id} attempt {attempt} failed ({result.get('error')}), retry in {retry_in:.1f}s")
+            else:
+                update_photo_job(job_id, status="error", error=result.get("error", "Generation failed"))
+                print(f"[PHOTO JOB] {job_id} failed after {attempt} attempts: {result.get('error')}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"[PHOTO JOB] {job_id} crashed: {e}")
+        finally:
+            db.session.remove()
+    
+    if retry_in is not None:
+        threading.Timer(retry_in, photo_executor.submit, args=(run_photo_job, job_id)).start()
+    else:
+        photo_queue_slots.release()
+
+
+def photo_job_owner(user_id):
+    return f"user:{user_id}" if user_id else f"ip:{request.headers.get('X-Forwarded-For', request.remote_addr or '')[:50]}"
+
+
+def submit_photo_job(kind, girl_id, params, user_id=None):
+    """Enqueues a generation; returns (job_id, None) or (None, error message) when a cap is hit"""
+    import uuid
+    owner = photo_job_owner(user_id)
+    active = PhotoJob.query.filter(
+        PhotoJob.owner == owner,
+        PhotoJob.status.in_(("queued", "running")),
+        PhotoJob.created_at > datetime.utcnow() - PHOTO_JOB_STALE_AFTER
+    ).count()
+    if active >= PHOTO_JOBS_PER_USER:
+        return None, "Too many photos in progress"
+    if not photo_queue_slots.acquire(blocking=False):
+        return None, "Photo queue is full"
+    
+    try:
+        job = PhotoJob(id=uuid.uuid4().hex, user_id=user_id, owner=owner, kind=kind, girl_id=girl_id,
+                       params=json.dumps(params), status="queued", worker=photo_job_worker(),
+                       heartbeat_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        photo_queue_slots.release()
+        raise
+    photo_executor.submit(run_photo_job, job.id)
+    return job.id, None
+
+
+def recover_photo_jobs():
+    """Re-enqueues photo jobs whose process stopped heartbeating (restarted or crashed worker);
+    the ones too old for their client to still be polling (or out of attempts) are marked as errors"""
+    from sqlalchemy import and_, or_
+    now = datetime.utcnow()
+    cutoff = now - PHOTO_JOB_LEASE
+    # Rows from before heartbeats existed fall back on updated_at
+    orphaned = and_(PhotoJob.status.in_(("queued", "running")),
+                    or_(PhotoJob.heartbeat_at < cutoff,
+                        and_(PhotoJob.heartbeat_at.is_(None), PhotoJob.updated_at < cutoff)))
+    orphans = PhotoJob.query.filter(orphaned).all()
+    worker = photo_job_worker() if orphans else None
+    resumed = failed = 0
+    for job in orphans:
+        # Conditional update: with several workers starting, the first one refreshes the
+        # heartbeat and the others no longer see the job as orphaned
+        claimed = PhotoJob.query.filter(PhotoJob.id == job.id, orphaned)\
+            .update({"status": "queued", "worker": worker, "heartbeat_at": now, "updated_at": now},
+                    synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue
+        if job.created_at < now - PHOTO_JOB_STALE_AFTER or (job.attempts or 0) >= PHOTO_JOB_MAX_ATTEMPTS \
+                or not photo_queue_slots.acquire(blocking=False):
+            update_photo_job(job.id, status="error", error="Interrupted by a server restart")
+            failed += 1
+            continue
+        photo_executor.submit(run_photo_job, job.id)
+        resumed += 1
+    if orphans:
+        print(f"[PHOTO JOB] Recovered orphaned jobs: {resumed} re-enqueued, {failed} marked as error")
+
+
+photo_jobs_recovered = threading.Event()
+
+
+@app.before_request
+def recover_photo_jobs_once():
+    # First request of a serving process (not at import, so CLI commands never start generations)
+    if photo_jobs_recovered.is_set():
+        return
+    photo_jobs_recovered.set()
+    try:
+        recover_photo_jobs()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[PHOTO JOB] Recovery failed: {e}")
+
+
+def photo_job_payload(job):
+    payload = {"job_id": job.id, "kind": job.kind, "status": job.status, "girl_id": job.girl_id, "attempts": job.attempts}
+    if job.image_url:
+        payload["image_url"] = job.image_url
+    if job.error and job.status == "error":
+        payload["error"] = job.error
+    return payload
+
+
+def get_visible_photo_job(job_id):
+    job = PhotoJob.query.get(job_id)
+    if not job or (job.user_id and job.user_id != session.get('user_id')):
+        return None
+    return job
+
+
+@app.route('/api/jobs/photo', methods=['POST'])
+def create_photo_job():
+    if not API_KEY:
+        return jsonify({"error": "PROMPTCHAN_KEY not set"}), 503
+    
+    data = request.json or {}
+    kind = data.get('kind', 'photo')
+    girl_id = data.get('girl', 'anastasia')
+    if kind not in ("photo", "profile", "camgirl"):
+        return jsonify({"error": "Unknown job kind"}), 400
+    
+    params = {
+        "description": data.get('description', ''),
+        "affection": data.get('affection', 20),
+        "photo_type": data.get('photo_type', 0 if kind == "profile" else None)
+    }
+    job_id, error = submit_photo_job(kind, girl_id, params, session.get('user_id'))
+    if error:
+        return jsonify({"error": error}), 429
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_photo_job(job_id):
+    job = get_visible_photo_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(photo_job_payload(job))
 
 
 FACE_VARIATIONS = ["oval face shape", "round face shape", "square jaw", "heart shaped face", "long face", "diamond face shape"]
@@ -6693,15 +9109,12 @@ PROFILE_PHOTO_TYPES = [
 
 NEGATIVE_PROMPT = "extra limbs, missing limbs, wonky fingers, mismatched boobs, extra boobs, asymmetrical boobs, extra fingers, too many thumbs, random dicks, free floating dicks, extra pussies, deformed face, ugly, blurry, bad anatomy"
 
-@app.route('/profile_photo', methods=['POST'])
-def profile_photo():
-    if not API_KEY:
-        return jsonify({"error": "PROMPTCHAN_KEY not set"})
-    
-    data = request.json
-    girl_id = data.get('girl', 'anastasia')
-    photo_type = data.get('photo_type', 0)
-    
+def generate_profile_photo(girl_id, photo_type=0):
+    """Profile photo generation + Supabase/DB persistence. Returns {"image_url": ...} or {"error": ...}"""
+    return single_flight_profile_photo(girl_id, photo_type, lambda: promptchan_profile_photo(girl_id, photo_type))
+
+
+def promptchan_profile_photo(girl_id, photo_type):
     girl = GIRLS.get(girl_id, GIRLS['anastasia'])
     
     photo_config = PROFILE_PHOTO_TYPES[photo_type % len(PROFILE_PHOTO_TYPES)]
@@ -6712,13 +9125,8 @@ def profile_photo():
     profile_prompt = f"{girl['appearance']}, {face_var}, {feature_var}, {photo_config['prompt_suffix']}, high quality"
     
     try:
-        response = requests.post(
-            'https://prod.aicloudnetservices.com/api/external/create',
-            headers={
-                'Content-Type': 'application/json',
-                'x-api-key': API_KEY
-            },
-            json={
+        response = promptchan_create(
+            {
                 "style": photo_config['style'],
                 "pose": photo_config['pose'],
                 "prompt": profile_prompt,
@@ -6738,9 +9146,9 @@ def profile_photo():
         
         if response.status_code == 401:
             print(f"[PROFILE] ERROR: API key invalid or expired!")
-            return jsonify({"error": "API key expired", "status": 401})
+            return {"error": "API key expired", "status": 401}
         
-        if response.ok:
+        if response.is_success:
             result = response.json()
             print(f"[PROFILE] API Result keys: {result.keys()}")
             image_val = result.get('image', result.get('image_url', result.get('data', {}).get('image', '')))
@@ -6753,40 +9161,133 @@ def profile_photo():
                 permanent_url = upload_to_supabase(image_val, girl_id, photo_type)
                 final_url = permanent_url if permanent_url else image_val
                 
-                try:
-                    existing = ProfilePhoto.query.filter_by(girl_id=girl_id, photo_type=photo_type).first()
-                    if existing:
-                        existing.photo_url = final_url
-                    else:
-                        new_photo = ProfilePhoto(girl_id=girl_id, photo_type=photo_type, photo_url=final_url)
-                        db.session.add(new_photo)
-                    db.session.commit()
+                if save_profile_photo(girl_id, photo_type, final_url):
                     print(f"[DB] Saved photo for {girl_id} type {photo_type}: {final_url[:50]}...")
-                except Exception as db_err:
-                    print(f"DB save error: {db_err}")
-                    db.session.rollback()
                 
-                return jsonify({"image_url": final_url, "girl_id": girl_id, "photo_type": photo_config['type']})
+                return {"image_url": final_url, "girl_id": girl_id, "photo_type": photo_config['type']}
             
-        return jsonify({"error": "No image in response"})
+        return {"error": "No image in response"}
             
     except Exception as e:
         print(f"Profile photo error: {e}")
-        return jsonify({"error": str(e)})
+        return {"error": str(e)}
+
+
+@app.route('/profile_photo', methods=['POST'])
+def profile_photo():
+    if not API_KEY:
+        return jsonify({"error": "PROMPTCHAN_KEY not set"})
+    
+    data = request.json
+    return jsonify(generate_profile_photo(data.get('girl', 'anastasia'), data.get('photo_type', 0)))
+
+
+# Profile photos are shared by every user and only change when one is generated: a
+# read-through cache of girl_id -> {"photos": {photo_type: url}, "derivatives": {...}}
+# (girls without photos included) keeps deck and profile views off the DB.
+# save_profile_photo() and finished derivatives invalidate; the TTL catches other workers' writes.
+PROFILE_PHOTO_CACHE_TTL = float(os.environ.get("PROFILE_PHOTO_CACHE_TTL", "300"))
+PROFILE_PHOTO_CACHE_SIZE = int(os.environ.get("PROFILE_PHOTO_CACHE_SIZE", "5000"))
+STORED_PHOTOS_BATCH_MAX = 100
+
+profile_photo_cache = OrderedDict()
+profile_photo_cache_lock = threading.Lock()
+# Bumped by every invalidation so a read that raced with one does not store what it loaded
+profile_photo_cache_generation = 0
+
+
+def invalidate_profile_photos(girl_id=None, photo_url=None):
+    global profile_photo_cache_generation
+    with profile_photo_cache_lock:
+        profile_photo_cache_generation += 1
+        if girl_id:
+            profile_photo_cache.pop(girl_id, None)
+        if photo_url:
+            for key, (_, entry) in list(profile_photo_cache.items()):
+                if photo_url in entry["photos"].values():
+                    del profile_photo_cache[key]
+
+
+def get_stored_profile_photos(girl_ids):
+    """girl_id -> {"photos": {photo_type: url}, "derivatives": {photo_type: derivative}};
+    the girls not cached are loaded together in one query"""
+    now = time.monotonic()
+    result, missing = {}, []
+    with profile_photo_cache_lock:
+        generation = profile_photo_cache_generation
+        for girl_id in dict.fromkeys(girl_ids):
+            cached = profile_photo_cache.get(girl_id)
+            if cached and cached[0] > now:
+                profile_photo_cache.move_to_end(girl_id)
+                result[girl_id] = cached[1]
+            else:
+                missing.append(girl_id)
+    if not missing:
+        return result
+    
+    photos = {girl_id: {} for girl_id in missing}
+    for row in ProfilePhoto.query.filter(ProfilePhoto.girl_id.in_(missing)).all():
+        photos[row.girl_id][row.photo_type] = row.photo_url
+    derivatives = get_photo_derivatives(url for girl_photos in photos.values() for url in girl_photos.values())
+    
+    with profile_photo_cache_lock:
+        store = generation == profile_photo_cache_generation
+        for girl_id in missing:
+            entry = {
+                "photos": photos[girl_id],
+                "derivatives": {t: derivatives[url] for t, url in photos[girl_id].items() if url in derivatives}
+            }
+            result[girl_id] = entry
+            if store:
+                profile_photo_cache[girl_id] = (now + PROFILE_PHOTO_CACHE_TTL, entry)
+                profile_photo_cache.move_to_end(girl_id)
+        while len(profile_photo_cache) > PROFILE_PHOTO_CACHE_SIZE:
+            profile_photo_cache.popitem(last=False)
+    return result
 
 
 @app.route('/api/stored_photos/<girl_id>', methods=['GET'])
 def get_stored_photos(girl_id):
     """Get all stored photos for a girl from database"""
     try:
-        photos = ProfilePhoto.query.filter_by(girl_id=girl_id).all()
-        photo_dict = {p.photo_type: p.photo_url for p in photos}
-        return jsonify({"photos": photo_dict, "girl_id": girl_id})
+        entry = get_stored_profile_photos([girl_id])[girl_id]
+        return jsonify(dict(entry, girl_id=girl_id))
     except Exception as e:
         print(f"Get stored photos error: {e}")
         return jsonify({"photos": {}, "girl_id": girl_id})
 
 
+@app.route('/api/stored_photos', methods=['GET', 'POST'])
+def get_stored_photos_batch():
+    """Stored photos of many girls at once (?ids=a,b,c or {"ids": [...]}), with an ETag:
+    a deck whose photos have not changed gets a 304 without touching the DB"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        ids = (data.get('ids') or []) if isinstance(data, dict) else None
+    else:
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+    if not isinstance(ids, list) or len(ids) > STORED_PHOTOS_BATCH_MAX \
+            or not all(isinstance(i, str) for i in ids):
+        return jsonify({"error": f"ids must be a list of at most {STORED_PHOTOS_BATCH_MAX} girl ids"}), 400
+    
+    try:
+        girls = get_stored_profile_photos(ids)
+    except Exception as e:
+        print(f"Get stored photos error: {e}")
+        return jsonify({"error": "Stored photos unavailable"}), 503
+    
+    body = json.dumps({"girls": girls}, sort_keys=True)
+    etag = hashlib.sha256(body.encode()).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Revalidated on every use (ETag), never stored without it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 CAMGIRL_VIDEOS = {
     "camgirl_lola": {
         "name": "Lola_Hot69",
@@ -6969,75 +9470,251 @@ CAMGIRL_VIDEOS = {
 }
 
 
+# Video jobs: CAMGIRL_VIDEOS clips without a video_url are generated by Promptchan
+# (1-2 min per clip) in their own small pool, capped separately from photo jobs.
+# generated_videos holds one row per (camgirl, video id): it is both the job and the
+# stored result, so each clip is generated once and then listed by /api/camgirls.
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", "2"))
+VIDEO_QUEUE_LIMIT = int(os.environ.get("VIDEO_QUEUE_LIMIT", "10"))
+VIDEO_MAX_BYTES = 200 * 1024 * 1024
+# A queued/running row older than this (worker restarted) can be enqueued again
+VIDEO_JOB_STALE_AFTER = timedelta(minutes=15)
+# A failed clip can be retried after VIDEO_RETRY_BASE, doubling per attempt, up to VIDEO_MAX_ATTEMPTS
+VIDEO_RETRY_BASE = timedelta(minutes=int(os.environ.get("VIDEO_RETRY_BASE_MINUTES", "10")))
+VIDEO_MAX_ATTEMPTS = int(os.environ.get("VIDEO_MAX_ATTEMPTS", "3"))
+
+video_executor = ThreadPoolExecutor(max_workers=VIDEO_WORKERS, thread_name_prefix="video-job")
+video_queue_slots = threading.BoundedSemaphore(VIDEO_QUEUE_LIMIT)
+
+
+def find_camgirl_video(camgirl_id, video_id):
+    for video in CAMGIRL_VIDEOS.get(camgirl_id, {}).get("videos", []):
+        if video["id"] == video_id:
+            return video
+    return None
+
+
+def promptchan_video(camgirl_id, video_config):
+    camgirl = GIRLS.get(camgirl_id, GIRLS.get('camgirl_lola'))
+    video_prompt = f"{camgirl['appearance']}, {video_config['action']}, {video_config['decor']} background, webcam POV, camgirl streaming, ring light, bedroom setup, high quality video"
+    
+    print(f"[VIDEO] Camgirl: {camgirl['name']}, video: {video_config['title']}")
+    response = promptchan_create(
+        {
+            "style": "Photo XL+ v2",
+            "pose": "Default",
+            "prompt": video_prompt,
+            "quality": "Ultra",
+            "expression": "Smiling",
+            "age_slider": camgirl.get('age_slider', camgirl['age']),
+            "creativity": 50,
+            "restore_faces": True,
+            "seed": -1,
+            "negative_prompt": NEGATIVE_PROMPT,
+            "video": True,
+            "video_length": 4
+        },
+        timeout=180,
+        breaker="promptchan_video"
+    )
+    if response.status_code == 401:
+        return {"error": "API key expired", "status": 401}
+    if not response.is_success:
+        return {"error": f"Promptchan returned {response.status_code}"}
+    
+    result = response.json()
+    video_url = result.get('video', result.get('video_url', result.get('data', {}).get('video', '')))
+    if not video_url:
+        return {"error": "No video in response"}
+    return {"video_url": video_url, "image_url": result.get('image', result.get('image_url', ''))}
+
+
+def store_generated_video(video_url, camgirl_id, video_id):
+    """Copies a Promptchan video to the storage backend; returns the original URL if that fails"""
+    import tempfile
+    storage = get_storage()
+    if not storage:
+        return video_url
+    try:
+        size = 0
+        with http_stream("GET", video_url, timeout=120) as response, \
+                tempfile.NamedTemporaryFile(prefix="video-", suffix=".mp4") as spool:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(chunk_size=UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > VIDEO_MAX_BYTES:
+                    raise ValueError(f"video larger than {VIDEO_MAX_BYTES} bytes")
+                spool.write(chunk)
+            spool.flush()
+            with open(spool.name, 'rb') as upload_file:
+                return call_with_breaker("storage", storage.put, f"videos/{camgirl_id}/{video_id}.mp4",
+                                         upload_file, response.headers.get('Content-Type', 'video/mp4'))
+    except Exception as e:
+        print(f"[VIDEO] Could not store {camgirl_id} video {video_id}: {e}")
+        return video_url
+
+
+def update_generated_video(row_id, **fields):
+    video = GeneratedVideo.query.get(row_id)
+    for key, value in fields.items():
+        setattr(video, key, value)
+    video.updated_at = datetime.utcnow()
+    db.session.commit()
+    return video
+
+
+def run_video_job(row_id):
+    with app.app_context():
+        try:
+            video = GeneratedVideo.query.get(row_id)
+            camgirl_id, video_id = video.camgirl_id, video.video_id
+            update_generated_video(row_id, status="running", attempts=(video.attempts or 0) + 1)
+            started = time.monotonic()
+            video_config = find_camgirl_video(camgirl_id, video_id)
+            try:
+                result = promptchan_video(camgirl_id, video_config)
+            except Exception as e:
+                result = {"error": str(e)}
+            
+            if result.get("video_url"):
+                video_url = store_generated_video(result["video_url"], camgirl_id, video_id)
+                update_generated_video(row_id, status="done", video_url=video_url,
+                                       image_url=result.get("image_url") or None, error=None)
+                print(f"[VIDEO JOB] {camgirl_id} video {video_id} done in {time.monotonic() - started:.0f}s")
+            else:
+                update_generated_video(row_id, status="error", error=result.get("error", "unknown error"))
+                print(f"[VIDEO JOB] {camgirl_id} video {video_id} failed: {result.get('error')}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"[VIDEO JOB] {row_id} crashed: {e}")
+        finally:
+            db.session.remove()
+            video_queue_slots.release()
+
+
+def video_in_progress(video):
+    return video.status in ("queued", "running") and video.updated_at > datetime.utcnow() - VIDEO_JOB_STALE_AFTER
+
+
+def video_retry_due(video):
+    """A failed clip is retried only after a backoff, and never past VIDEO_MAX_ATTEMPTS"""
+    attempts = video.attempts or 0
+    if attempts >= VIDEO_MAX_ATTEMPTS:
+        return False
+    return video.updated_at <= datetime.utcnow() - VIDEO_RETRY_BASE * (2 ** max(attempts - 1, 0))
+
+
+def submit_video_job(camgirl_id, video_id):
+    """Enqueues a clip unless it is already generated, in progress or cooling down after a failure;
+    returns (GeneratedVideo, None) or (None, error)"""
+    from sqlalchemy.exc import IntegrityError
+    existing = GeneratedVideo.query.filter_by(camgirl_id=camgirl_id, video_id=video_id).first()
+    if existing and (existing.status == "done" or video_in_progress(existing)):
+        return existing, None
+    if existing and existing.status == "error" and not video_retry_due(existing):
+        return existing, None
+    if not video_queue_slots.acquire(blocking=False):
+        return None, "Video queue is full"
+    
+    try:
+        if existing is None:
+            video = GeneratedVideo(camgirl_id=camgirl_id, video_id=video_id, status="queued")
+            db.session.add(video)
+            db.session.commit()
+        else:
+            # Failed or stale: the conditional update lets a single worker re-enqueue it
+            claimed = GeneratedVideo.query.filter_by(id=existing.id, status=existing.status, updated_at=existing.updated_at)\
+                .update({"status": "queued", "error": None, "updated_at": datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            video = GeneratedVideo.query.get(existing.id)
+            if claimed != 1:
+                video_queue_slots.release()
+                return video, None
+    except IntegrityError:
+        db.session.rollback()
+        video_queue_slots.release()
+        return GeneratedVideo.query.filter_by(camgirl_id=camgirl_id, video_id=video_id).first(), None
+    except Exception:
+        db.session.rollback()
+        video_queue_slots.release()
+        raise
+    video_executor.submit(run_video_job, video.id)
+    return video, None
+
+
+def video_job_payload(video):
+    payload = {"camgirl": video.camgirl_id, "video_id": video.video_id, "status": video.status, "attempts": video.attempts}
+    if video.video_url:
+        payload["video_url"] = video.video_url
+    if video.image_url:
+        payload["image_url"] = video.image_url
+    if video.error and video.status == "error":
+        payload["error"] = video.error
+    return payload
+
+
+def get_generated_video_urls():
+    """{(camgirl_id, video_id): video_url} for every generated clip"""
+    rows = db.session.query(GeneratedVideo.camgirl_id, GeneratedVideo.video_id, GeneratedVideo.video_url)\
+        .filter(GeneratedVideo.status == "done").all()
+    return {(row.camgirl_id, row.video_id): row.video_url for row in rows}
+
+
+@app.route('/api/jobs/video', methods=['POST'])
+def create_video_job():
+    if not session.get('user_id'):
+        return jsonify({"error": "Not logged in"}), 401
+    if not API_KEY:
+        return jsonify({"error": "PROMPTCHAN_KEY not set"}), 503
+    
+    data = request.json or {}
+    camgirl_id = data.get('camgirl', '')
+    video_id = data.get('video_id')
+    if not find_camgirl_video(camgirl_id, video_id):
+        return jsonify({"error": "Unknown video"}), 404
+    
+    video, error = submit_video_job(camgirl_id, video_id)
+    if error:
+        return jsonify({"error": error}), 429
+    return jsonify(video_job_payload(video)), 200 if video.status == "done" else 202
+
+
+@app.route('/api/videos/<camgirl_id>/<int:video_id>', methods=['GET'])
+def get_video_job(camgirl_id, video_id):
+    video = GeneratedVideo.query.filter_by(camgirl_id=camgirl_id, video_id=video_id).first()
+    if not video:
+        return jsonify({"error": "Video not found"}), 404
+    return jsonify(video_job_payload(video))
+
+
 @app.route('/api/generate_video_test', methods=['POST'])
 def generate_video_test():
-    """Test video generation with Promptchan API - Lola strip tease"""
+    """Test video generation with Promptchan API - enqueues the clip and returns its job"""
+    if not session.get('user_id'):
+        return jsonify({"error": "Not logged in"}), 401
     if not API_KEY:
         return jsonify({"error": "PROMPTCHAN_KEY not set"}), 400
     
     data = request.json or {}
     camgirl_id = data.get('camgirl', 'camgirl_lola')
     video_index = data.get('video_index', 0)
+    if camgirl_id not in CAMGIRL_VIDEOS:
+        camgirl_id = 'camgirl_lola'
     
-    camgirl = GIRLS.get(camgirl_id, GIRLS.get('camgirl_lola'))
-    camgirl_videos = CAMGIRL_VIDEOS.get(camgirl_id, CAMGIRL_VIDEOS.get('camgirl_lola'))
-    video_config = camgirl_videos['videos'][video_index % len(camgirl_videos['videos'])]
-    
-    video_prompt = f"{camgirl['appearance']}, {video_config['action']}, {video_config['decor']} background, webcam POV, camgirl streaming, ring light, bedroom setup, high quality video"
-    
-    print(f"[VIDEO TEST] Camgirl: {camgirl['name']}")
-    print(f"[VIDEO TEST] Video: {video_config['title']}")
-    print(f"[VIDEO TEST] Prompt: {video_prompt[:200]}...")
+    camgirl_videos = CAMGIRL_VIDEOS[camgirl_id]['videos']
+    video_config = camgirl_videos[video_index % len(camgirl_videos)]
+    video, error = submit_video_job(camgirl_id, video_config['id'])
+    if error:
+        return jsonify({"error": error}), 429
     
-    try:
-        response = requests.post(
-            'https://prod.aicloudnetservices.com/api/external/create',
-            headers={
-                'Content-Type': 'application/json',
-                'x-api-key': API_KEY
-            },
-            json={
-                "style": "Photo XL+ v2",
-                "pose": "Default",
-                "prompt": video_prompt,
-                "quality": "Ultra",
-                "expression": "Smiling",
-                "age_slider": camgirl.get('age_slider', camgirl['age']),
-                "creativity": 50,
-                "restore_faces": True,
-                "seed": -1,
-                "negative_prompt": NEGATIVE_PROMPT,
-                "video": True,
-                "video_length": 4
-            },
-            timeout=120
-        )
-        
-        print(f"[VIDEO TEST] API Response status: {response.status_code}")
-        print(f"[VIDEO TEST] API Response headers: {dict(response.headers)}")
-        
-        if response.status_code == 401:
-            return jsonify({"error": "API key expired", "status": 401}), 401
-        
-        result = response.json()
-        print(f"[VIDEO TEST] API Result: {result}")
-        
-        video_url = result.get('video', result.get('video_url', result.get('data', {}).get('video', '')))
-        image_url = result.get('image', result.get('image_url', ''))
-        
-        return jsonify({
-            "success": True,
-            "camgirl": camgirl['name'],
-            "video_title": video_config['title'],
-            "video_url": video_url,
-            "image_url": image_url,
-            "full_response": result,
-            "prompt_used": video_prompt[:300]
-        })
-        
-    except Exception as e:
-        print(f"[VIDEO TEST] Error: {e}")
-        return jsonify({"error": str(e)}), 500
+    payload = video_job_payload(video)
+    payload.update({
+        "success": True,
+        "camgirl": GIRLS.get(camgirl_id, {}).get('name', camgirl_id),
+        "video_title": video_config['title'],
+        "status_url": f"/api/videos/{camgirl_id}/{video_config['id']}"
+    })
+    return jsonify(payload), 200 if video.status == "done" else 202
 
 
 @app.route('/api/register', methods=['POST'])
@@ -7158,13 +9835,44 @@ def add_match():
     if existing:
         return jsonify({"success": True, "did_match": True, "affection": existing.affection, "girl_id": girl_id})
     
-    match = Match(user_id=user_id, girl_id=girl_id, affection=20)
-    db.session.add(match)
-    db.session.commit()
+    from sqlalchemy.exc import IntegrityError
+    try:
+        match = Match(user_id=user_id, girl_id=girl_id, affection=20)
+        db.session.add(match)
+        db.session.commit()
+    except IntegrityError:
+        # Concurrent request created it first (uq_matches_user_girl)
+        db.session.rollback()
+        existing = Match.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+        return jsonify({"success": True, "did_match": True, "affection": existing.affection, "girl_id": girl_id})
     
     return jsonify({"success": True, "did_match": True, "affection": 20, "girl_id": girl_id})
 
 
+@app.route('/api/matches/<girl_id>', methods=['DELETE'])
+def remove_match(girl_id):
+    """Unmatch (or block with ?block=1); other devices get the tombstone from /api/sync"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    
+    block = request.args.get('block') in ('1', 'true')
+    match = Match.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+    if block:
+        # Blocked profiles never come back in the swipe deck
+        discovered = DiscoveredProfile.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+        if discovered:
+            discovered.action = 'blocked'
+        else:
+            db.session.add(DiscoveredProfile(user_id=user_id, girl_id=girl_id, action='blocked'))
+    if match:
+        if block:
+            db.session.info.setdefault('sync_blocks', set()).add((user_id, girl_id))
+        db.session.delete(match)
+    db.session.commit()
+    return jsonify({"success": True, "girl_id": girl_id, "blocked": block})
+
+
 @app.route('/api/affection', methods=['POST'])
 def update_affection():
     user_id = session.get('user_id')
@@ -7185,18 +9893,275 @@ def update_affection():
     return jsonify({"success": True, "affection": match.affection})
 
 
+# Chat history is paged newest-first with a keyset cursor on (timestamp, id), so a page
+# costs the same however long the conversation is (ix_chat_messages_user_girl_time_id).
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_MAX = 200
+
+
+def encode_chat_cursor(message):
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_chat_cursor(cursor):
+    """(timestamp, id) from an encode_chat_cursor() string; ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor[:40]}")
+
+
+def chat_cursor_filter(timestamp, message_id):
+    """Messages strictly older than (timestamp, id)"""
+    from sqlalchemy import and_, or_
+    return or_(ChatMessage.timestamp < timestamp,
+               and_(ChatMessage.timestamp == timestamp, ChatMessage.id < message_id))
+
+
+def chat_message_payload(message):
+    return {
+        "id": message.id,
+        "sender": message.sender,
+        "role": "user" if message.sender == "user" else "assistant",
+        "content": message.content,
+        "time": message.time_str
+    }
+
+
 @app.route('/api/chat/<girl_id>', methods=['GET'])
 def get_chat(girl_id):
+    """One page of history, oldest first within the page; pass next_cursor as ?before= for the page before"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    
+    limit = min(max(request.args.get('limit', CHAT_PAGE_SIZE, type=int), 1), CHAT_PAGE_MAX)
+    query = ChatMessage.query.filter_by(user_id=user_id, girl_id=girl_id)
+    before = request.args.get('before')
+    if before:
+        try:
+            query = query.filter(chat_cursor_filter(*decode_chat_cursor(before)))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    messages = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return jsonify({
+        "messages": [chat_message_payload(m) for m in messages],
+        "next_cursor": encode_chat_cursor(messages[0]) if has_more else None,
+        "has_more": has_more
+    })
+
+
+def conversation_unread_counts(user_id):
+    """girl_id -> messages from her after the read marker, in one grouped query"""
+    from sqlalchemy import and_, func
+    return dict(
+        db.session.query(ChatMessage.girl_id, func.count(ChatMessage.id))
+        .outerjoin(ChatReadMarker, and_(ChatReadMarker.user_id == ChatMessage.user_id,
+                                        ChatReadMarker.girl_id == ChatMessage.girl_id))
+        .filter(ChatMessage.user_id == user_id, ChatMessage.sender != 'user',
+                ChatMessage.id > func.coalesce(ChatReadMarker.last_read_id, 0))
+        .group_by(ChatMessage.girl_id).all()
+    )
+
+
+def recent_chat_windows(user_id, size):
+    """girl_id -> {"messages", "next_cursor"}: the last `size` messages of every conversation, in one query"""
+    from sqlalchemy import func
+    ranked = db.session.query(
+        ChatMessage.id,
+        func.row_number().over(
+            partition_by=ChatMessage.girl_id,
+            order_by=(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        ).label('rank')
+    ).filter(ChatMessage.user_id == user_id).subquery()
+    # One extra row per conversation tells whether an older page exists
+    rows = ChatMessage.query.join(ranked, ChatMessage.id == ranked.c.id)\
+        .filter(ranked.c.rank <= size + 1)\
+        .order_by(ChatMessage.girl_id, ChatMessage.timestamp, ChatMessage.id).all()
+    
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.girl_id, []).append(row)
+    windows = {}
+    for girl_id, messages in grouped.items():
+        has_more = len(messages) > size
+        messages = messages[-size:]
+        windows[girl_id] = {
+            "messages": [chat_message_payload(m) for m in messages],
+            "next_cursor": encode_chat_cursor(messages[0]) if has_more else None
+        }
+    return windows
+
+
+# Chat messages per conversation included in /api/bootstrap; older ones come from ?before= pages
+BOOTSTRAP_CHAT_WINDOW = 20
+
+
+@app.route('/api/bootstrap', methods=['GET'])
+def bootstrap():
+    """Everything the app needs after login in one response, with a fixed number of
+    queries whatever the number of matches (instead of one /api/chat and one
+    /api/stored_photos request per match)"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    
+    user = User.query.get(user_id)
+    if not user:
+        session.pop('user_id', None)
+        return jsonify({"error": "Not logged in"}), 401
+    
+    # Read first: anything changed while the rest is loaded comes again with the next /api/sync
+    version = current_sync_version(user_id)
+    matches = Match.query.filter_by(user_id=user_id).all()
+    match_ids = [m.girl_id for m in matches]
+    discovered = DiscoveredProfile.query.filter_by(user_id=user_id).all()
+    received = ReceivedPhoto.query.filter_by(user_id=user_id).order_by(ReceivedPhoto.received_at.desc()).all()
+    stored = get_stored_profile_photos(match_ids)
+    
+    received_photos = {}
+    for photo in received:
+        received_photos.setdefault(photo.girl_id, []).append(photo.photo_url)
+    profile_photos = {girl_id: entry["photos"] for girl_id, entry in stored.items() if entry["photos"]}
+    derivatives = {}
+    for entry in stored.values():
+        for photo_type, derivative in entry["derivatives"].items():
+            derivatives[entry["photos"][photo_type]] = derivative
+    
+    return jsonify({
+        "version": version,
+        "user": {"id": user.id, "username": user.username, "age": user.age},
+        "matches": [{"girl_id": m.girl_id, "affection": m.affection} for m in matches],
+        "discovered": [{"girl_id": d.girl_id, "action": d.action} for d in discovered],
+        "chats": recent_chat_windows(user_id, BOOTSTRAP_CHAT_WINDOW),
+        "unread": conversation_unread_counts(user_id),
+        "received_photos": received_photos,
+        "profile_photos": profile_photos,
+        "derivatives": derivatives
+    })
+
+
+def current_sync_version(user_id):
+    state = UserSyncState.query.get(user_id)
+    return state.version if state else 0
+
+
+def sync_changes_query(model, user_id, since, until):
+    return model.query.filter(model.user_id == user_id, model.sync_version > since, model.sync_version <= until)
+
+
+# A client further behind than this reloads everything from /api/bootstrap instead
+SYNC_MAX_CHANGES = 500
+
+
+@app.route('/api/sync', methods=['GET'])
+def sync_changes():
+    """Rows changed since ?since=<version> (from /api/bootstrap or a previous sync), plus
+    tombstones for deletions. Only versions up to the returned one are included: the
+    counter is locked until commit, so every row at or below it is already visible."""
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({"error": "Not logged in"}), 401
     
-    messages = ChatMessage.query.filter_by(user_id=user_id, girl_id=girl_id).order_by(ChatMessage.timestamp).all()
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since is required (version from /api/bootstrap)"}), 400
+    
+    version = current_sync_version(user_id)
+    if since > version:
+        # Version from another database or a reset account
+        return jsonify({"version": version, "reset": True})
+    
+    changes = {}
+    for key, model in (("matches", Match), ("messages", ChatMessage), ("received_photos", ReceivedPhoto),
+                       ("discovered", DiscoveredProfile), ("tombstones", SyncTombstone)):
+        rows = sync_changes_query(model, user_id, since, version)\
+            .order_by(model.sync_version, model.id).limit(SYNC_MAX_CHANGES + 1).all()
+        if len(rows) > SYNC_MAX_CHANGES:
+            return jsonify({"version": version, "reset": True})
+        changes[key] = rows
+    
     return jsonify({
-        "messages": [{"sender": m.sender, "content": m.content, "time": m.time_str} for m in messages]
+        "version": version,
+        "reset": False,
+        "matches": [{"girl_id": m.girl_id, "affection": m.affection} for m in changes["matches"]],
+        "messages": [dict(chat_message_payload(m), girl_id=m.girl_id) for m in changes["messages"]],
+        "received_photos": [{"id": p.id, "girl_id": p.girl_id, "photo_url": p.photo_url}
+                            for p in changes["received_photos"]],
+        "discovered": [{"girl_id": d.girl_id, "action": d.action} for d in changes["discovered"]],
+        "tombstones": [{"kind": t.kind, "girl_id": t.girl_id, "record_id": t.record_id}
+                       for t in changes["tombstones"]],
+        "unread": conversation_unread_counts(user_id) if changes["messages"] else None
     })
 
 
+@app.route('/api/conversations', methods=['GET'])
+def get_conversations():
+    """Messages list: last message and unread count per girl, in two grouped queries"""
+    from sqlalchemy import func
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    
+    last_ids = db.session.query(func.max(ChatMessage.id).label('last_id'))\
+        .filter(ChatMessage.user_id == user_id).group_by(ChatMessage.girl_id).subquery()
+    last_messages = ChatMessage.query.join(last_ids, ChatMessage.id == last_ids.c.last_id).all()
+    unread = conversation_unread_counts(user_id)
+    
+    conversations = []
+    for message in sorted(last_messages, key=lambda m: m.id, reverse=True):
+        preview = re.sub(r'\[PHOTO:[^\]]*\]', '', message.content).strip()
+        conversations.append({
+            "girl_id": message.girl_id,
+            "last_message": {
+                "id": message.id,
+                "role": "user" if message.sender == "user" else "assistant",
+                "preview": preview[:80],
+                "time": message.time_str,
+                "timestamp": message.timestamp.isoformat() if message.timestamp else None
+            },
+            "unread": unread.get(message.girl_id, 0)
+        })
+    return jsonify({"conversations": conversations})
+
+
+@app.route('/api/chat/<girl_id>/read', methods=['POST'])
+def mark_chat_read(girl_id):
+    """Moves the read marker to last_id (default: the latest message)"""
+    from sqlalchemy import func
+    from sqlalchemy.exc import IntegrityError
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    
+    data = request.json or {}
+    last_id = data.get('last_id') or db.session.query(func.max(ChatMessage.id))\
+        .filter(ChatMessage.user_id == user_id, ChatMessage.girl_id == girl_id).scalar() or 0
+    
+    marker = ChatReadMarker.query.filter_by(user_id=user_id, girl_id=girl_id).first()
+    if marker:
+        marker.last_read_id = max(marker.last_read_id or 0, last_id)
+        marker.updated_at = datetime.utcnow()
+    else:
+        db.session.add(ChatReadMarker(user_id=user_id, girl_id=girl_id, last_read_id=last_id))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        ChatReadMarker.query.filter(ChatReadMarker.user_id == user_id, ChatReadMarker.girl_id == girl_id,
+                                    ChatReadMarker.last_read_id < last_id)\
+            .update({"last_read_id": last_id, "updated_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+    return jsonify({"success": True, "last_read_id": last_id})
+
+
 @app.route('/api/chat/<girl_id>', methods=['POST'])
 def save_message(girl_id):
     user_id = session.get('user_id')
@@ -7212,7 +10177,7 @@ def save_message(girl_id):
     db.session.add(message)
     db.session.commit()
     
-    return jsonify({"success": True})
+    return jsonify({"success": True, "id": message.id})
 
 
 @app.route('/api/received_photos', methods=['GET'])
@@ -7255,6 +10220,7 @@ def get_gallery():
         return jsonify({"error": "Not logged in"}), 401
     
     photos = ReceivedPhoto.query.filter_by(user_id=user_id).order_by(ReceivedPhoto.received_at.desc()).all()
+    derivatives = get_photo_derivatives(p.photo_url for p in photos)
     
     gallery = {}
     total_photos = 0
@@ -7267,8 +10233,11 @@ def get_gallery():
                 "photos": [],
                 "count": 0
             }
+        derivative = derivatives.get(p.photo_url, {})
         gallery[p.girl_id]["photos"].append({
             "url": p.photo_url,
+            "variants": derivative.get("variants", {}),
+            "placeholder": derivative.get("placeholder"),
             "received_at": p.received_at.isoformat() if p.received_at else None
         })
         gallery[p.girl_id]["count"] += 1
@@ -7367,7 +10336,31 @@ def get_games():
                 "min_affection": game["min_affection"]
             })
     
-    return jsonify({"games": available_games})
+    response = {"games": available_games}
+    girl_archetype = get_girl_archetype(girl_id)
+    if girl_archetype:
+        archetype_name, archetype = girl_archetype
+        response["archetype"] = archetype_name
+        response["archetype_games"] = archetype["jeux"]
+    
+    return jsonify(response)
+
+
+@app.route('/api/archetypes', methods=['GET'])
+def get_archetypes():
+    """Archetype -> girl_ids index, optionally restricted with ?archetype=soumise,dominante"""
+    wanted = request.args.get('archetype')
+    names = [n for n in wanted.split(',') if n in ARCHETYPE_GIRLS] if wanted else list(ARCHETYPE_GIRLS)
+    
+    return jsonify({
+        "archetypes": {
+            name: {
+                "style": AGENT_ARCHETYPES[name]["style"],
+                "count": len(ARCHETYPE_GIRLS[name]),
+                "girl_ids": ARCHETYPE_GIRLS[name]
+            } for name in names
+        }
+    })
 
 
 @app.route('/api/games/start', methods=['POST'])
@@ -7481,6 +10474,7 @@ def save_discovered():
     girl_id = data.get('girl_id')
     action = data.get('action', 'passed')
     
+    from sqlalchemy.exc import IntegrityError
     existing = DiscoveredProfile.query.filter_by(user_id=user_id, girl_id=girl_id).first()
     if existing:
         existing.action = action
@@ -7488,7 +10482,13 @@ def save_discovered():
         d = DiscoveredProfile(user_id=user_id, girl_id=girl_id, action=action)
         db.session.add(d)
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # Through the ORM rather than a bulk update, so the change gets a sync version
+        DiscoveredProfile.query.filter_by(user_id=user_id, girl_id=girl_id).first().action = action
+        db.session.commit()
     return jsonify({"success": True})
 
 
@@ -7624,6 +10624,8 @@ def create_custom_character():
         "custom": True,
         "creator_id": user_id
     }
+    index_girl_archetype(girl_id, GIRLS[girl_id])
+    COMPILED_PROMPTS[girl_id] = compile_girl_prompt(GIRLS[girl_id])
     
     return jsonify({
         "success": True,
@@ -7677,6 +10679,7 @@ def get_stories():
     now = datetime.utcnow()
     
     active_stories = Story.query.filter(Story.expires_at > now).order_by(Story.created_at.desc()).all()
+    derivatives = get_photo_derivatives(s.photo_url for s in active_stories)
     
     stories_by_girl = {}
     for s in active_stories:
@@ -7689,6 +10692,8 @@ def get_stories():
         stories_by_girl[s.girl_id]["stories"].append({
             "id": s.id,
             "photo_url": s.photo_url,
+            "variants": derivatives.get(s.photo_url, {}).get("variants", {}),
+            "placeholder": derivatives.get(s.photo_url, {}).get("placeholder"),
             "context": s.context,
             "caption": s.caption,
             "created_at": s.created_at.isoformat() if s.created_at else None,
@@ -7736,10 +10741,15 @@ def get_story_contexts():
 @app.route('/api/camgirls', methods=['GET'])
 def get_camgirls():
     camgirls = []
+    generated = get_generated_video_urls()
     for girl_id, girl in GIRLS.items():
         if girl.get("camgirl"):
             camgirl_data = CAMGIRL_VIDEOS.get(girl_id, {})
-            videos = camgirl_data.get("videos", [])
+            videos = [
+                video if video.get("video_url") or (girl_id, video["id"]) not in generated
+                else dict(video, video_url=generated[(girl_id, video["id"])])
+                for video in camgirl_data.get("videos", [])
+            ]
             photos = camgirl_data.get("photos", [])
             camgirls.append({
                 "girl_id": girl_id,
@@ -7779,6 +10789,20 @@ def get_camgirl_photo(girl_id):
     if existing and existing.photo_url:
         return jsonify({"image_url": existing.photo_url})
     
+    if not API_KEY:
+        return jsonify({"image_url": None})
+    
+    # Generated in the photo job pool; the client can follow job_id
+    job_id, error = submit_photo_job("camgirl", girl_id, {}, session.get('user_id'))
+    return jsonify({"image_url": None, "job_id": job_id})
+
+
+def generate_camgirl_photo(girl_id):
+    return single_flight_profile_photo(girl_id, 3, lambda: promptchan_camgirl_photo(girl_id))
+
+
+def promptchan_camgirl_photo(girl_id):
+    girl = GIRLS.get(girl_id, {})
     try:
         ethnicity = girl.get("ethnicity", "european")
         body = girl.get("body_type", "curvy")
@@ -7788,11 +10812,6 @@ def get_camgirl_photo(girl_id):
         
         prompt = f"solo, 1girl, {ethnicity}, {age_str}, {body} body, {breast} breasts, {hair} hair, lingerie, webcam girl, bedroom, seductive pose, looking at viewer, soft lighting, intimate setting"
         
-        api_url = "https://prod.aicloudnetservices.com/api/external/create"
-        headers = {
-            "Content-Type": "application/json",
-            "x-api-key": API_KEY
-        }
         payload = {
             "style": "Photo XL+ v2",
             "prompt": prompt,
@@ -7801,7 +10820,7 @@ def get_camgirl_photo(girl_id):
             "expression": "Default"
         }
         
-        response = requests.post(api_url, headers=headers, json=payload, timeout=60)
+        response = promptchan_create(payload, timeout=60)
         if response.status_code == 200:
             data = response.json()
             image_url = data.get("image") or data.get("url") or data.get("image_url") or (data.get("images") or [{}])[0].get("url")
@@ -7809,15 +10828,14 @@ def get_camgirl_photo(girl_id):
             if image_url:
                 supabase_url = upload_to_supabase(image_url, girl_id, "lingerie")
                 if supabase_url:
-                    photo = ProfilePhoto(girl_id=girl_id, photo_type=3, photo_url=supabase_url)
-                    db.session.add(photo)
-                    db.session.commit()
-                    return jsonify({"image_url": supabase_url})
-                return jsonify({"image_url": image_url})
+                    save_profile_photo(girl_id, 3, supabase_url)
+                    return {"image_url": supabase_url}
+                return {"image_url": image_url}
     except Exception as e:
         print(f"Camgirl photo error: {e}")
+        return {"error": str(e)}
     
-    return jsonify({"image_url": None})
+    return {"error": "No image in response"}
 
 
 @app.route('/api/tip_menu', methods=['GET'])
@@ -7932,7 +10950,8 @@ def camgirl_chat():
     
     name = girl.get("name", "Camgirl")
     personality = girl.get("personality", "")
-    archetype = girl.get("archetype", "nympho")
+    # Her own style label (e.g. "exhib") first; the resolved agent archetype only when she has none
+    archetype = girl.get("archetype") or GIRL_ARCHETYPES.get(girl_id) or "nympho"
     
     system_prompt = f"""Tu es {name}, une camgirl francaise en live stream.
 Ton style: {archetype}
@@ -7950,7 +10969,9 @@ REGLES:
     
     try:
         if openrouter_client:
-            response = openrouter_client.chat.completions.create(
+            response = call_with_breaker(
+                "openrouter",
+                openrouter_client.chat.completions.create,
                 model="mistralai/mistral-medium-3",
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -8040,6 +11061,355 @@ def live_cam_action():
     })
 
 
+@app.cli.command('bench-prompts')
+@click.option('--rounds', default=50, help='Assemblies per girl for each implementation')
+def bench_prompts(rounds):
+    """Compare the old per-request .replace() chain with compiled prompts over all GIRLS"""
+    import random
+    
+    def legacy_system_content(girl, affection, mood, mood_instruction, photo_instruction, msg_count):
+        personality = girl.get('personality', DEFAULT_PERSONALITY)
+        archetype_name = resolve_archetype(girl)
+        archetype = AGENT_ARCHETYPES.get(archetype_name, AGENT_ARCHETYPES["romantique"])
+        system_content = SYSTEM_PROMPT.replace("{name}", girl['name'])\
+            .replace("{age}", str(girl['age']))\
+            .replace("{affection}", str(affection))\
+            .replace("{personality}", personality)\
+            .replace("{mood}", mood)\
+            .replace("{job}", girl.get('tagline', 'inconnue'))\
+            .replace("{country}", girl.get('location', 'quelque part'))\
+            .replace("{likes}", girl.get('likes', 'les bons moments'))\
+            .replace("{dislikes}", girl.get('dislikes', 'les relous'))\
+            .replace("{archetype}", archetype_name.upper())\
+            .replace("{archetype_style}", archetype['style'])\
+            .replace("{archetype_expressions}", ', '.join(random.sample(archetype['expressions'], min(3, len(archetype['expressions'])))))\
+            .replace("{archetype_fantasmes}", ', '.join(random.sample(archetype['fantasmes'], min(3, len(archetype['fantasmes'])))))\
+            .replace("{archetype_jeux}", random.choice(archetype['jeux']))\
+            .replace("{archetype_anecdotes}", random.choice(archetype['anecdotes']))
+        system_content += f"\n\n{mood_instruction}\n{photo_instruction}"
+        special_instruction = render_special_instruction(girl.get('special', None), msg_count)
+        if special_instruction:
+            system_content += f"\n\n{special_instruction}"
+        if girl.get('fantasmes'):
+            system_content += f"\n\nTes fantasmes specifiques: {girl['fantasmes']}"
+        return system_content
+    
+    args = (42, "neutral", "Tu es neutre, tu discutes normalement.", "Tu peux envoyer des photos sexy mais pas nue.", 12)
+    
+    mismatches = 0
+    for girl_id, girl in GIRLS.items():
+        random.seed(girl_id)
+        legacy = legacy_system_content(girl, *args)
+        random.seed(girl_id)
+        compiled = render_system_prompt(get_compiled_prompt(girl_id, girl), *args)
+        if legacy != compiled:
+            mismatches += 1
+            print(f"Mismatch for {girl_id}")
+    
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for girl in GIRLS.values():
+            legacy_system_content(girl, *args)
+    legacy_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    compile_all_prompts()
+    compile_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for girl_id, girl in GIRLS.items():
+            render_system_prompt(get_compiled_prompt(girl_id, girl), *args)
+    compiled_time = time.perf_counter() - started
+    
+    assemblies = rounds * len(GIRLS)
+    print(f"Girls: {len(GIRLS)}, assemblies per implementation: {assemblies}, mismatches: {mismatches}")
+    print(f"Legacy .replace() chain: {legacy_time / assemblies * 1e6:.1f} us/prompt")
+    print(f"Compiled templates:      {compiled_time / assemblies * 1e6:.1f} us/prompt (one-off compile of all girls: {compile_time * 1000:.1f} ms)")
+    print(f"Speedup: {legacy_time / compiled_time:.1f}x")
+
+
+
+BENCH_CHAT_MESSAGES = [
+    "Salut toi, ça va ?", "t'es vraiment belle sur ta photo de profil", "tu fais quoi ce soir ?",
+    "haha t'es trop drôle mdr", "tu peux me montrer ta tenue ?", "envoie moi une photo de toi au lit",
+    "j'ai trop envie de toi ce soir", "montre moi tes seins", "t'es chaude toi", "tu veux voir un film ?",
+    "je bosse dans la technique, c'est normal que je rentre tard", "on se voit demain à la plage ?",
+    "envoie une photo en maillot de bain", "tu peux te mettre à quatre pattes ?", "t'as un joli cul",
+    "je t'adore vraiment, t'es adorable", "regarde ce que j'ai acheté", "tu continues ton avenue préférée ?",
+    "salope", "tu me fais rire", "je suis excité", "raconte moi ta journée", "en levrette ?",
+    "une photo sous la douche stp", "t'es magnifique en robe", "on peut parler de calcul ?",
+]
+
+
+@app.cli.command('bench-keywords')
+@click.option('--rounds', default=200, help='Passes over the sample chat corpus')
+def bench_keywords(rounds):
+    """Compare the old substring loops with the single-pass keyword automaton"""
+    
+    def legacy_scan(text):
+        text = text.lower()
+        pose_id = None
+        for candidate, pose_data in POSE_LIBRARY.items():
+            if any(trigger in text for trigger in pose_data.get("triggers", [])):
+                pose_id = candidate
+                break
+        pose_keyword = next((pose for keyword, pose in POSE_KEYWORDS.items() if keyword in text), None)
+        expression = next((expr for keyword, expr in EXPRESSION_KEYWORDS.items() if keyword in text), None)
+        flags = {category: any(w in text for w in words) for category, words in (
+            ("photo", PHOTO_TRIGGER_WORDS), ("rude", RUDE_WORDS), ("rushing", RUSHING_WORDS),
+            ("too_early", TOO_EARLY_WORDS), ("compliment", COMPLIMENT_WORDS), ("horny", HORNY_WORDS),
+            ("explicit", EXPLICIT_WORDS))}
+        return pose_id, pose_keyword, expression, flags
+    
+    def automaton_scan(text):
+        scan = scan_message_uncached(text)
+        return scan["pose_id"], scan["pose_keyword"], scan["expression"], {c: scan[c] for c in MESSAGE_FLAG_CATEGORIES}
+    
+    differences = 0
+    for message in BENCH_CHAT_MESSAGES:
+        legacy, current = legacy_scan(message), automaton_scan(message)
+        if legacy != current:
+            differences += 1
+            changed = [c for c in MESSAGE_FLAG_CATEGORIES if legacy[3][c] != current[3][c]]
+            print(f"Differs: {message!r} pose {legacy[0]}->{current[0]} keyword {legacy[1]}->{current[1]} "
+                  f"expression {legacy[2]}->{current[2]} flags {changed}")
+    
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in BENCH_CHAT_MESSAGES:
+            legacy_scan(message)
+    legacy_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in BENCH_CHAT_MESSAGES:
+            automaton_scan(message)
+    automaton_time = time.perf_counter() - started
+    
+    scans = rounds * len(BENCH_CHAT_MESSAGES)
+    keywords = sum(len(output) for output in MESSAGE_AUTOMATON.output if output)
+    print(f"Messages: {len(BENCH_CHAT_MESSAGES)}, scans per implementation: {scans}, automaton keywords: {keywords}, "
+          f"states: {len(MESSAGE_AUTOMATON.goto)}, differing messages: {differences}")
+    print(f"Legacy substring loops: {legacy_time / scans * 1e6:.1f} us/message")
+    print(f"Keyword automaton:      {automaton_time / scans * 1e6:.1f} us/message")
+    print(f"Speedup: {legacy_time / automaton_time:.1f}x")
+
+
+class RateLimiter:
+    """Spaces calls evenly: at most `per_minute` starts per minute across threads"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def load_pregen_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"done": {}, "failed": {}}
+
+
+def save_pregen_checkpoint(path, checkpoint):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+@app.cli.command('pregen')
+@click.option('--dry-run', is_flag=True, help='List what would be generated and exit')
+@click.option('--concurrency', default=3, help='Generations running at the same time')
+@click.option('--rate', default=20.0, help='Max generations started per minute (Promptchan limit)')
+@click.option('--checkpoint', default='pregen_checkpoint.json', help='Progress file, reused to resume')
+@click.option('--girls', default='', help='Comma-separated girl ids (default: all GIRLS)')
+@click.option('--types', default='', help='Comma-separated photo types 0-4 (default: all PROFILE_PHOTO_TYPES)')
+@click.option('--limit', default=0, help='Stop after this many generations (0 = no limit)')
+@click.option('--verify-storage', is_flag=True, help='Regenerate saved photos whose stored object is missing')
+def pregen(dry_run, concurrency, rate, checkpoint, girls, types, limit, verify_storage):
+    """Warm the GIRLS x PROFILE_PHOTO_TYPES matrix: generate, upload to Supabase and save every missing profile photo"""
+    girl_ids = [g.strip() for g in girls.split(',') if g.strip()] or list(GIRLS.keys())
+    photo_types = [int(t) for t in types.split(',') if t.strip()] or list(range(len(PROFILE_PHOTO_TYPES)))
+    unknown = [g for g in girl_ids if g not in GIRLS]
+    if unknown:
+        raise click.BadParameter(f"Unknown girls: {', '.join(unknown)}", param_hint='--girls')
+    
+    saved = db.session.query(ProfilePhoto.girl_id, ProfilePhoto.photo_type, ProfilePhoto.photo_url).all()
+    existing = {(p.girl_id, p.photo_type) for p in saved}
+    progress = load_pregen_checkpoint(checkpoint)
+    if verify_storage:
+        storage = get_storage()
+        if not storage:
+            raise click.ClickException("No storage backend configured")
+        paths = dict(db.session.query(StoredObject.public_url, StoredObject.path)
+                     .filter(StoredObject.public_url.in_([p.photo_url for p in saved])).all())
+        present = storage.exists_many(set(paths.values()))
+        missing = {(p.girl_id, p.photo_type) for p in saved if p.photo_url in paths and paths[p.photo_url] not in present}
+        print(f"[PREGEN] {len(missing)} saved photos missing from {storage.name} storage")
+        existing -= missing
+        for girl_id, photo_type in missing:
+            progress["done"].pop(f"{girl_id}:{photo_type}", None)
+    todo = [(g, t) for g in girl_ids for t in photo_types
+            if (g, t) not in existing and f"{g}:{t}" not in progress["done"]]
+    if limit:
+        todo = todo[:limit]
+    
+    total = len(girl_ids) * len(photo_types)
+    print(f"[PREGEN] {total} pairs, {total - len(todo)} already present, {len(todo)} to generate")
+    if dry_run:
+        for girl_id, photo_type in todo[:20]:
+            print(f"  {girl_id} type {photo_type} ({PROFILE_PHOTO_TYPES[photo_type]['type']})")
+        if len(todo) > 20:
+            print(f"  ... and {len(todo) - 20} more")
+        if rate > 0:
+            print(f"[PREGEN] Estimated duration at {rate:g}/min: {len(todo) / rate:.1f} min")
+        return
+    if not todo:
+        return
+    if not API_KEY:
+        raise click.ClickException("PROMPTCHAN_KEY not set")
+    
+    limiter = RateLimiter(rate)
+    breaker = CIRCUIT_BREAKERS["promptchan"]
+    progress_lock = threading.Lock()
+    stop = threading.Event()
+    latencies = []
+    failures = []
+    
+    def generate_pair(girl_id, photo_type):
+        if stop.is_set():
+            return
+        while breaker.is_open() and not stop.is_set():
+            time.sleep(5)
+        limiter.wait()
+        started = time.monotonic()
+        with app.app_context():
+            result = generate_profile_photo(girl_id, photo_type)
+        latency = time.monotonic() - started
+        key = f"{girl_id}:{photo_type}"
+        with progress_lock:
+            if result.get("image_url"):
+                latencies.append(latency)
+                progress["done"][key] = result["image_url"]
+                progress["failed"].pop(key, None)
+                print(f"[PREGEN] {key} ok in {latency:.1f}s ({len(latencies) + len(failures)}/{len(todo)})")
+            else:
+                failures.append(key)
+                progress["failed"][key] = result.get("error", "unknown error")
+                print(f"[PREGEN] {key} failed in {latency:.1f}s: {result.get('error')}")
+                if result.get("status") == 401:
+                    stop.set()
+            save_pregen_checkpoint(checkpoint, progress)
+    
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="pregen") as pool:
+        try:
+            for future in [pool.submit(generate_pair, g, t) for g, t in todo]:
+                future.result()
+        except KeyboardInterrupt:
+            stop.set()
+            print("[PREGEN] Interrupted, finishing running generations (progress is checkpointed)")
+    elapsed = time.monotonic() - started
+    
+    print(f"[PREGEN] Generated {len(latencies)}, failed {len(failures)}, in {elapsed:.0f}s "
+          f"({len(latencies) / elapsed * 60 if elapsed else 0:.1f}/min)")
+    if latencies:
+        ordered = sorted(latencies)
+        p50 = ordered[len(ordered) // 2]
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        print(f"[PREGEN] Latency p50 {p50:.1f}s, p95 {p95:.1f}s, max {ordered[-1]:.1f}s")
+    if failures:
+        print(f"[PREGEN] Failed pairs are listed in {checkpoint}; run again to retry them")
+    if stop.is_set():
+        raise click.ClickException("Stopped early (API key rejected or interrupted)")
+
+# Hot per-user queries and the index each one must use (checked by `flask check-indexes`)
+def index_checked_queries():
+    now = datetime.utcnow()
+    return [
+        ("add_match/update_affection", "uq_matches_user_girl",
+         Match.query.filter_by(user_id=1, girl_id='jade')),
+        ("get_chat", "ix_chat_messages_user_girl_time_id",
+         ChatMessage.query.filter_by(user_id=1, girl_id='jade').filter(chat_cursor_filter(now, 100))
+         .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(CHAT_PAGE_SIZE + 1)),
+        ("load_conversation", "ix_chat_messages_user_girl_id",
+         ChatMessage.query.filter_by(user_id=1, girl_id='jade').order_by(ChatMessage.id.desc()).limit(CHAT_CONTEXT_WINDOW)),
+        ("update_conversation_summary", "uq_conversation_summaries_user_girl",
+         ConversationSummary.query.filter_by(user_id=1, girl_id='jade')),
+        ("save_discovered", "uq_discovered_profiles_user_girl",
+         DiscoveredProfile.query.filter_by(user_id=1, girl_id='jade')),
+        ("get_received_photos", "ix_received_photos_user_time",
+         ReceivedPhoto.query.filter_by(user_id=1).order_by(ReceivedPhoto.received_at.desc())),
+        ("save_profile_photo", "uq_profile_photos_girl_type",
+         ProfilePhoto.query.filter_by(girl_id='jade', photo_type=0)),
+        ("get_stories", "ix_stories_expires",
+         Story.query.filter(Story.expires_at > now).order_by(Story.created_at.desc())),
+        ("get_custom_girls", "ix_custom_girls_user",
+         CustomGirl.query.filter_by(user_id=1)),
+        ("sync_changes", "ix_chat_messages_user_sync",
+         sync_changes_query(ChatMessage, 1, 10, 20).order_by(ChatMessage.sync_version, ChatMessage.id)),
+        ("submit_photo_job", "ix_photo_jobs_owner_status",
+         PhotoJob.query.filter(PhotoJob.owner == 'user:1', PhotoJob.status.in_(("queued", "running")))),
+    ]
+
+
+@app.cli.command('check-indexes')
+def check_indexes():
+    """EXPLAIN every hot query and fail if one does not use its index"""
+    postgres = db.engine.dialect.name == 'postgresql'
+    failures = []
+    with db.engine.begin() as conn:
+        if postgres:
+            # Tiny tables make the planner prefer a scan anyway: only ask whether the index is usable
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        for name, index_name, query in index_checked_queries():
+            compiled = query.statement.compile(db.engine, compile_kwargs={"render_postcompile": True})
+            params = tuple(compiled.params[key] for key in compiled.positiontup) if compiled.positional else compiled.params
+            prefix = "EXPLAIN " if postgres else "EXPLAIN QUERY PLAN "
+            plan = '\n'.join(' '.join(str(col) for col in row) for row in conn.exec_driver_sql(prefix + str(compiled), params))
+            ok = index_name in plan
+            if not ok:
+                failures.append(name)
+            print(f"[INDEXES] {'ok  ' if ok else 'FAIL'} {name}: {index_name}")
+            if not ok:
+                print('    ' + plan.replace('\n', '\n    '))
+    if failures:
+        raise click.ClickException(f"{len(failures)} queries not using their index: {', '.join(failures)}")
+
+
+@app.cli.command('build-renditions')
+def build_renditions():
+    """Pre-build the ?w= WebP renditions of every image in attached_assets"""
+    built = 0
+    started = time.monotonic()
+    for root, _, files in os.walk(ATTACHED_ASSETS_DIR):
+        for name in files:
+            if not name.lower().endswith(RENDITION_EXTENSIONS):
+                continue
+            source_path = os.path.join(root, name)
+            filename = os.path.relpath(source_path, ATTACHED_ASSETS_DIR).replace(os.sep, '/')
+            for width in DERIVATIVE_WIDTHS:
+                if os.path.exists(asset_rendition_path(filename, width)):
+                    continue
+                try:
+                    build_asset_rendition(source_path, filename, width)
+                    built += 1
+                except Exception as e:
+                    print(f"[ASSETS] {filename} at {width}px failed: {e}")
+    print(f"[ASSETS] Built {built} renditions in {time.monotonic() - started:.1f}s")
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)